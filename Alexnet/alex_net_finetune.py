@@ -7,28 +7,31 @@ finetune alexnet with tensorflow in other task
 @author: MarkLiu
 @time  : 17-3-6 上午11:23
 """
-import h5py
 import tensorflow as tf
 
 import utils
 from alex_net import Alexnet
-from datautil import DataWapper
+from datautil import BatchAugmenter, load_mnist_finetune
+from trainer import BottleneckModel, StreamingEvaluator, Trainer, build_bottleneck_cache, step_decay
 
 print('load train datas...')
 
 num_classes = 10
 train_split = 0.85  # training/validation split
+# 默认读取 mnist_reshape 预先生成的 HDF5 文件; True 时训练时实时 resize 原始 mnist 数据
+upsample_on_the_fly = False
+# 图片的存储格式: 'bgr_float16', 或者体积更小的 'rgb_uint8'/'gray_uint8' (在模型图中减均值),
+# 读取 HDF5 文件时需与 mnist_reshape 生成文件时的 storage 一致
+storage = 'bgr_float16'
+# 训练数据增强 (默认关闭): 随机缩放裁剪、平移和亮度扰动, 在进程池中对整个 batch 进行, 与训练并行
+augment = False
+# 冻结 train_layers 之前的层: 只在第一次运行时计算一次该层 ('fc6' 或 'pool5') 的输出并缓存,
+# 之后每个 epoch 只训练 train_layers, 不再做数据增强; None 时训练整个模型
+bottleneck_layer = None
 
-data = h5py.File(utils.train_mnist_2_imagenet_size_file, 'r')
-images = data['images'][:]
-labels = data['labels'][:]
-
-# split data into training and validation sets
-train_samples = int(len(images) * train_split)
-train_features = images[:train_samples]
-train_labels = labels[:train_samples]
-validation_features = images[train_samples:]
-validation_labels = labels[train_samples:]
+# 按顺序划分 train/validation (前 train_split 为 train), 保存在 utils.mnist_split_file 中, 每次运行使用相同的划分
+train_datas, validate_datas, test_datas = load_mnist_finetune('alexnet', train_split, upsample_on_the_fly,
+                                                              storage=storage, split_file=utils.mnist_split_file)
 
 # Parameters
 learning_rate = 0.001
@@ -36,39 +39,40 @@ training_epochs = 10
 batch_size = 200
 display_step = 1
 train_layers = ['fc8', 'fc7']
-total_batch = int(train_samples / batch_size)
 
 alexnet = Alexnet(num_classes=num_classes, activation=tf.nn.relu,
-                  skip_layer=train_layers, weights_path=utils.pre_trained_alex_model)
+                  skip_layer=train_layers, weights_path=utils.pre_trained_alex_model,
+                  input_storage=storage, head_training=bottleneck_layer is not None)
 alexnet.init()
 alexnet.load_initial_weights()
 
-train_datas = DataWapper(train_features, train_labels)
-validate_datas = DataWapper(validation_features, validation_labels)
+model = alexnet
+checkpoint_name = 'alexnet'
+if bottleneck_layer is not None:
+    cache_name = 'mnist_227x227_%s' % storage
+    train_datas = build_bottleneck_cache(alexnet, bottleneck_layer, train_datas, cache_name + '_train', batch_size)
+    validate_datas = build_bottleneck_cache(alexnet, bottleneck_layer, validate_datas, cache_name + '_validate',
+                                            batch_size)
+    model = BottleneckModel(alexnet, bottleneck_layer)
+    checkpoint_name += '_' + bottleneck_layer
+    augment = False
 
-# training
+# training: Trainer 在后台预取 (和增强) 训练 batch, 学习率在第 1 个 epoch 之后及每 4 个 epoch 减半
+# checkpoint 在后台写入, 重新运行时从中断处的下一个 batch 继续训练
+augmenter = BatchAugmenter(min_crop_scale=0.85, max_shift=8, brightness=20.) if augment else None
+trainer = Trainer(model, train_datas, batch_size, step_decay(learning_rate, 4), keep_prob=0.8,
+                  validate_datas=validate_datas, eval_every=display_step, augmenter=augmenter,
+                  checkpoint_dir=utils.checkpoint_path + checkpoint_name + '/', checkpoint_every_steps=200,
+                  best_checkpoint_dir=utils.best_checkpoint_path + checkpoint_name + '/', resume=True)
 print('Train model ...')
-for epoch in range(0, training_epochs):
-    avg_loss = 0.
-    for i in range(0, total_batch):
-        batch_x, batch_y = train_datas.next_batch(batch_size)
-        train_loss, train_accuracy = alexnet.train(batch_x, batch_y, learning_rate, keep_prob=0.8)
-        avg_loss += train_loss / total_batch
-        print("train loss = %.9f, train accuracy = %.5f" % (train_loss, train_accuracy))
-
-    if epoch % display_step == 0:
-        batch_x, batch_y = validate_datas.next_batch(batch_size * 2)
-        accuracy = alexnet.get_accuracy(x=batch_x, y=batch_y)
-        print("Epoch: %04d, train loss = %.9f, validation accuracy = %.5f" % (epoch + 1, avg_loss, accuracy))
-    if epoch % 4 == 0:
-        learning_rate /= 2
-
+trainer.fit(training_epochs)
 print('Train end.')
+print('timing: %s' % trainer.timing())
+trainer.close()
 print('Predict ...')
-print('load test datas...')
-data = h5py.File(utils.test_mnist_2_imagenet_size_file, 'r')
-test_images = data['images'][:]
-test_labels = data['labels'][:]
-print('load datas done!')
-predict_accuracy = alexnet.get_accuracy(x=test_images, y=test_labels)
-print('predict_accuracy = %.5f' % predict_accuracy)
+if bottleneck_layer is not None:
+    test_datas = build_bottleneck_cache(alexnet, bottleneck_layer, test_datas, cache_name + '_test', batch_size)
+# 按 batch 流式评估整个 test 数据集, 不把所有图片读入内存
+result = StreamingEvaluator(model, batch_size=batch_size * 2).evaluate(test_datas)
+print('predict_accuracy = %.5f, predict loss = %.9f' % (result['accuracy'], result['loss']))
+print('per class accuracy: %s' % result['per_class_accuracy'])
@@ -3,46 +3,131 @@
 
 """
 Alexnet predict ImageNet demo.
+对目录 (包括子目录) 中的所有图片分类: 线程池并行解码、resize, 按 batch 调用 classify,
+图片以流的方式处理, 内存中只保留正在处理的几个 batch.
 
 @author: MarkLiu
 @time  : 17-3-6 上午11:23
 """
-from alex_net import Alexnet
-from caffe_classes import class_names
-import tensorflow as tf
-import utils
-import numpy as np
+import argparse
 import os
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
 import cv2
+import numpy as np
+import tensorflow as tf
+
+import utils
+from alex_net import Alexnet
+from caffe_classes import class_names
+
+# mean of imagenet dataset in BGR
+imagenet_mean = np.array([104., 117., 124.], dtype=np.float32)
+image_extensions = ('.jpeg', '.jpg', '.png', '.bmp')
+
+
+def iter_image_files(image_dir, extensions=image_extensions):
+    """
+    逐个产生目录及其子目录中的图片文件
+    """
+    for root, dirs, files in os.walk(image_dir):
+        dirs.sort()
+        for f in sorted(files):
+            if f.lower().endswith(extensions):
+                yield os.path.join(root, f)
+
+
+def load_image(path):
+    """
+    读取图片, resize 为 (227x227) 并减均值, 无法解码时返回 None
+    """
+    image = cv2.imread(path)
+    if image is None:
+        return None
+    # Convert image to float32 and resize to (227x227), 与原来一样在 float32 上插值
+    image = cv2.resize(image.astype(np.float32), (227, 227))
+    # Subtract the ImageNet mean
+    image -= imagenet_mean
+    return image
+
+
+def iter_decoded_images(paths, threads=4, max_pending=None):
+    """
+    在线程池中解码图片, 按 paths 的顺序产生 (path, image), 最多同时有 max_pending 张图片在解码或等待使用.
+    cv2 的解码和 resize 会释放 GIL, 多个线程可以并行.
+    """
+    max_pending = max_pending or 4 * threads
+    pool = ThreadPool(threads)
+    try:
+        pending = deque()
+        paths = iter(paths)
+        while True:
+            while len(pending) < max_pending:
+                path = next(paths, None)
+                if path is None:
+                    break
+                pending.append((path, pool.apply_async(load_image, (path,))))
+            if not pending:
+                break
+            path, task = pending.popleft()
+            yield path, task.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_image_batches(decoded_images, batch_size):
+    """
+    将 (path, image) 组成 batch, 产生 (paths, images), 跳过无法解码的图片
+    """
+    paths = []
+    images = np.empty((batch_size, 227, 227, 3), dtype=np.float32)
+    for path, image in decoded_images:
+        if image is None:
+            print('skip ' + path + ': cannot decode image')
+            continue
+        images[len(paths)] = image
+        paths.append(path)
+        if len(paths) == batch_size:
+            yield paths, images
+            paths = []
+            images = np.empty((batch_size, 227, 227, 3), dtype=np.float32)
+    if paths:
+        yield paths, images[:len(paths)]
 
 
 def main():
+    parser = argparse.ArgumentParser(description='classify all images of a directory with the pre-trained Alexnet')
+    parser.add_argument('image_dir', nargs='?', default=os.path.join(os.getcwd(), 'images'))
+    parser.add_argument('--batch-size', type=int, default=64, help='images per classify call')
+    parser.add_argument('--threads', type=int, default=4, help='image decoding threads')
+    parser.add_argument('--report-every', type=int, default=100, help='report images/sec every N batches')
+    args = parser.parse_args()
+
     alexnet = Alexnet(num_classes=1000, activation=tf.nn.relu,
-                      skip_layer=[], weights_path=utils.pre_trained_alex_model)
+                      skip_layer=[], weights_path=utils.pre_trained_alex_model, input_storage='bgr_float32')
 
     alexnet.init()
     # Load the pretrained weights into the non-trainable layer
     alexnet.load_initial_weights()
 
-    # mean of imagenet dataset in BGR
-    imagenet_mean = np.array([104., 117., 124.], dtype=np.float32)
-
-    current_dir = os.getcwd()
-    image_dir = os.path.join(current_dir, 'images')
-    # get list of all images
-    img_files = [os.path.join(image_dir, f) for f in os.listdir(image_dir) if f.endswith('.jpeg')]
-
-    # load all images
-    imgs = []
-    for f in img_files:
-        imgs.append(cv2.imread(f))
-
-    for i, image in enumerate(imgs):
-        # Convert image to float32 and resize to (227x227)
-        image = cv2.resize(image.astype(np.float32), (227, 227))
-        # Subtract the ImageNet mean
-        image -= imagenet_mean
-        image = image.reshape((1, 227, 227, 3))
-        predict_y, prob = alexnet.classify(image)
-        class_name = class_names[int(predict_y)]
-        print('image ' + str(i) + ':' + class_name)
+    decoded_images = iter_decoded_images(iter_image_files(args.image_dir), args.threads,
+                                         max_pending=2 * args.batch_size)
+    image_count = 0
+    start = time.time()
+    for batch_index, (paths, images) in enumerate(iter_image_batches(decoded_images, args.batch_size)):
+        predict_y, prob = alexnet.classify(images)
+        for path, label, image_prob in zip(paths, predict_y, prob):
+            print('%s: %s (%.4f)' % (path, class_names[int(label)], image_prob[label]))
+        image_count += len(paths)
+        if (batch_index + 1) % args.report_every == 0:
+            print('%d images, %.1f images/sec' % (image_count, image_count / (time.time() - start)))
+
+    elapsed = time.time() - start
+    print('classified %d images in %.1fs, %.1f images/sec' % (image_count, elapsed, image_count / max(elapsed, 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
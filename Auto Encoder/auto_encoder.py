@@ -15,19 +15,26 @@ from __future__ import print_function
 
 import tensorflow as tf
 
+import tfutil
+
 
 class Autoencoders(object):
     """
     Autoencoders model
     """
 
-    def __init__(self, input_layer_size, activation_fun):
+    def __init__(self, input_layer_size, activation_fun, input_tensors=None, batch_size=None):
         self.input_layer_size = input_layer_size
         self.activation_fun = activation_fun
+        # 输入流水线的 (images, labels) tensor, 不 feed x 时从中读取 images, 见 tfutil.dataset_input_pipeline
+        self.input_tensors = input_tensors
+        # 静态的 batch 维度, None 为动态; 设置后 feed 的每个 batch 都必须是该大小, 见 DataWapper 的 last_batch
+        self.batch_size = batch_size
 
     def build_model(self):
         # input features
-        self.x = tf.placeholder(tf.float32, shape=[None, self.input_layer_size], name='input_layer')
+        input_x = self.input_tensors[0] if self.input_tensors else None
+        self.x = tfutil.input_placeholder(tf.float32, [self.batch_size, self.input_layer_size], 'input_layer', input_x)
         # dropout
         self.keep_prob = tf.placeholder(tf.float32)
         self.learning_rate = tf.placeholder(tf.float32, name='learning_rate')
@@ -68,9 +75,13 @@ class Autoencoders(object):
         self.sess.run(init_op)
 
     def train(self, x, learning_rate, keep_prob=0.5):
-        cost, _ = self.sess.run((self.loss_function, self.training_op), feed_dict={self.x: x,
-                                                                                   self.learning_rate: learning_rate,
-                                                                                   self.keep_prob: keep_prob})
+        """
+        训练, x 为 None 时从输入流水线 (input_tensors) 读取 batch
+        """
+        feed_dict = {self.learning_rate: learning_rate, self.keep_prob: keep_prob}
+        if x is not None:
+            feed_dict[self.x] = x
+        cost, _ = self.sess.run((self.loss_function, self.training_op), feed_dict=feed_dict)
         return cost
 
     def encode(self, x):
@@ -107,13 +118,18 @@ class AdditiveGaussianNoiseAutoencoder(object):
     AdditiveGaussianNoiseAutoencoder model
     """
 
-    def __init__(self, input_layer_size, activation_fun):
+    def __init__(self, input_layer_size, activation_fun, input_tensors=None, batch_size=None):
         self.input_layer_size = input_layer_size
         self.activation_fun = activation_fun
+        # 输入流水线的 (images, labels) tensor, 不 feed x 时从中读取 images, 见 tfutil.dataset_input_pipeline
+        self.input_tensors = input_tensors
+        # 静态的 batch 维度, None 为动态; 设置后 feed 的每个 batch 都必须是该大小, 见 DataWapper 的 last_batch
+        self.batch_size = batch_size
 
     def build_model(self):
         # input features
-        self.x = tf.placeholder(tf.float32, shape=[None, self.input_layer_size], name='input_layer')
+        input_x = self.input_tensors[0] if self.input_tensors else None
+        self.x = tfutil.input_placeholder(tf.float32, [self.batch_size, self.input_layer_size], 'input_layer', input_x)
         # dropout
         self.keep_prob = tf.placeholder(tf.float32)
         # noise scale
@@ -157,9 +173,13 @@ class AdditiveGaussianNoiseAutoencoder(object):
         self.sess.run(init_op)
 
     def train(self, x, learning_rate, keep_prob=0.5):
-        cost, _ = self.sess.run((self.loss_function, self.training_op), feed_dict={self.x: x,
-                                                                                   self.learning_rate: learning_rate,
-                                                                                   self.keep_prob: keep_prob})
+        """
+        训练, x 为 None 时从输入流水线 (input_tensors) 读取 batch
+        """
+        feed_dict = {self.learning_rate: learning_rate, self.keep_prob: keep_prob}
+        if x is not None:
+            feed_dict[self.x] = x
+        cost, _ = self.sess.run((self.loss_function, self.training_op), feed_dict=feed_dict)
         return cost
 
     def encode(self, x):
@@ -6,16 +6,16 @@
 @time  : 17-3-15 下午7:18
 """
 import tensorflow as tf
-from tensorflow.examples.tutorials.mnist import input_data
 from auto_encoder import Autoencoders
 import numpy as np
 import utils
+from datautil import read_mnist
 import matplotlib as mpl
 import sklearn.preprocessing as prep
 import matplotlib.pyplot as plt
 
 print('load datas...')
-mnist = input_data.read_data_sets(utils.mnist_dir, one_hot=True)
+mnist = read_mnist(utils.mnist_dir)
 image_width = 28
 image_height = 28
 labels_size = 10
@@ -11,10 +11,13 @@ This example is using the MNIST database of handwritten digits
 """
 from __future__ import absolute_import, division, print_function
 
+import argparse
+
 import numpy as np
 import tensorflow as tf
-from tensorflow.examples.tutorials.mnist import input_data
 
+import tfutil
+from datautil import DataWapper, read_mnist
 from utils import mnist_dir
 
 
@@ -22,11 +25,15 @@ class ConvolutionalNetwork(object):
     """
     convolutional network model
     """
-    def __init__(self, image_width, image_height, labels_size, activation):
+    def __init__(self, image_width, image_height, labels_size, activation, input_tensors=None, batch_size=None):
         self.image_width = image_width
         self.image_height = image_height
         self.labels_size = labels_size
         self.activation = activation
+        # 输入流水线的 (images, labels) tensor, 不 feed x、y 时从中读取 batch, 见 tfutil.dataset_input_pipeline
+        self.input_tensors = input_tensors
+        # 静态的 batch 维度, None 为动态; 设置后 feed 的每个 batch 都必须是该大小, 见 DataWapper 的 last_batch
+        self.batch_size = batch_size
 
     def create_weight_variable(self, shape, name):
         initial = tf.truncated_normal(shape, stddev=0.01)
@@ -60,8 +67,10 @@ class ConvolutionalNetwork(object):
         构建模型
         """
         # input features
-        self.x = tf.placeholder(tf.float32, shape=[None, self.image_width * self.image_height], name='input_layer')
-        self.y = tf.placeholder(tf.float32, [None, self.labels_size], name='output_layer')
+        input_x, input_y = self.input_tensors or (None, None)
+        self.x = tfutil.input_placeholder(tf.float32, [self.batch_size, self.image_width * self.image_height],
+                                          'input_layer', input_x)
+        self.y = tfutil.input_placeholder(tf.float32, [self.batch_size, self.labels_size], 'output_layer', input_y)
 
         # reshape features to 2d shape
         self.x_image = tf.reshape(self.x, [-1, self.image_width, self.image_height, 1])
@@ -122,14 +131,15 @@ class ConvolutionalNetwork(object):
 
     def train(self, features_x, y, learning_rate, keep_prob=0.8):
         """
-        训练
+        训练, features_x、y 为 None 时从输入流水线 (input_tensors) 读取 batch
         """
         feed_dict = {
-            self.x: features_x,
-            self.y: y,
             self.keep_prob: keep_prob,
             self.learning_rate: learning_rate
         }
+        if features_x is not None:
+            feed_dict[self.x] = features_x
+            feed_dict[self.y] = y
         _, loss = self.sess.run([self.training_op, self.loss_function], feed_dict=feed_dict)
         return loss
 
@@ -154,8 +164,17 @@ class ConvolutionalNetwork(object):
 
 
 def main():
+    parser = argparse.ArgumentParser(description='train a convolutional network on mnist')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare training steps/sec of feed_dict and the tf.data input pipeline')
+    parser.add_argument('--benchmark-static-batch', action='store_true',
+                        help='compare training and inference speed of dynamic and static batch dimensions')
+    parser.add_argument('--input-pipeline', action='store_true',
+                        help='read training batches from the tf.data input pipeline instead of feed_dict')
+    args = parser.parse_args()
+
     print('load datas...')
-    mnist = input_data.read_data_sets(mnist_dir, one_hot=True)
+    mnist = read_mnist(mnist_dir)
 
     image_width = 28
     image_height = 28
@@ -169,14 +188,36 @@ def main():
 
     total_batch = int(mnist.train.num_examples / batch_size)
 
-    cnn = ConvolutionalNetwork(image_width, image_height, labels_size, activation=tf.nn.relu)
+    # 每个 batch 都是 batch_size 行
+    train_datas = DataWapper(mnist.train.images, mnist.train.labels, last_batch='drop_last')
+    if args.benchmark_static_batch:
+        def build_model(static_batch_size):
+            model = ConvolutionalNetwork(image_width, image_height, labels_size, activation=tf.nn.relu,
+                                         batch_size=static_batch_size)
+            model.init()
+            return model
+
+        tfutil.benchmark_static_batch(build_model, train_datas, batch_size)
+        return
+
+    # 使用输入流水线时训练 batch 在后台准备, 否则每一步通过 feed_dict 传入; --benchmark 比较两者
+    use_pipeline = args.input_pipeline or args.benchmark
+    input_tensors = tfutil.dataset_input_pipeline(train_datas, batch_size) if use_pipeline else None
+    cnn = ConvolutionalNetwork(image_width, image_height, labels_size, activation=tf.nn.relu,
+                               input_tensors=input_tensors)
 
     cnn.init()
+    if args.benchmark:
+        tfutil.benchmark_input_pipeline(lambda x, y: cnn.train(x, y, learning_rate, 0.8), train_datas, batch_size)
+        return
     for epoch in range(0, training_epochs):
         avg_cost = 0.
         for i in range(0, total_batch):
-            batch_x, batch_y = mnist.train.next_batch(batch_size)
-            cost = cnn.train(batch_x, batch_y, learning_rate, 0.8)
+            if use_pipeline:
+                cost = cnn.train(None, None, learning_rate, 0.8)
+            else:
+                batch_x, batch_y = train_datas.next_batch(batch_size)
+                cost = cnn.train(batch_x, batch_y, learning_rate, 0.8)
             avg_cost += cost / total_batch
 
         if epoch % display_step == 0:
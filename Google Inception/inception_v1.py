@@ -23,14 +23,23 @@ import tensorflow as tf
 import tensorflow.contrib.slim as slim
 from tensorflow.python import pywrap_tensorflow
 
+import tfutil
+
 
 class GoogleInceptionV1(object):
     """
     Google Inception V1 model
     """
 
-    def __init__(self, num_classes, skip_layer, pre_trained_model_cpkt='DEFAULT'):
+    def __init__(self, num_classes, skip_layer, pre_trained_model_cpkt='DEFAULT', input_storage='bgr_float16',
+                 input_tensors=None, batch_size=None):
         self.num_classes = num_classes
+        # 输入图片的存储格式, uint8 格式在图中减均值, 见 tfutil.image_input_layer
+        self.input_storage = input_storage
+        # 输入流水线的 (images, labels) tensor, 不 feed x、y 时从中读取 batch, 见 tfutil.dataset_input_pipeline
+        self.input_tensors = input_tensors
+        # 静态的 batch 维度, None 为动态; 设置后 feed 的每个 batch 都必须是该大小, 见 DataWapper 的 last_batch
+        self.batch_size = batch_size
         # 指定跳过加载 pre-trained 层
         self.skip_layer = skip_layer
         if pre_trained_model_cpkt == 'DEFAULT':
@@ -293,8 +302,10 @@ class GoogleInceptionV1(object):
         build basic inception v1 model
         """
         # input features [batch_size, height, width, channels]
-        self.x = tf.placeholder(tf.float32, shape=[None, 224, 224, 3], name='input_layer')
-        self.y = tf.placeholder(tf.float32, [None, self.num_classes], name='output_layer')
+        input_x, input_y = self.input_tensors or (None, None)
+        self.x, input_images = tfutil.image_input_layer(224, 224, self.input_storage, input_tensor=input_x,
+                                                        batch_size=self.batch_size)
+        self.y = tfutil.input_placeholder(tf.float32, [self.batch_size, self.num_classes], 'output_layer', input_y)
 
         # learning_rate placeholder
         self.learning_rate = tf.placeholder(tf.float32, name='learning_rate')
@@ -302,7 +313,7 @@ class GoogleInceptionV1(object):
         self.keep_prob = tf.placeholder(tf.float32, name='keep_prob')
 
         with tf.variable_scope(name_or_scope=scope, reuse=False) as scope:
-            net, ent_point_nets = self.inception_v1_base(self.x, scope=scope)
+            net, ent_point_nets = self.inception_v1_base(input_images, scope=scope)
             with tf.variable_scope('Logits'):
                 net = slim.avg_pool2d(net, kernel_size=[7, 7], stride=1, scope='MaxPool_0a_7x7')
                 net = slim.dropout(net, self.keep_prob, scope='Dropout_0b')
@@ -313,8 +324,9 @@ class GoogleInceptionV1(object):
 
     def init_train_test_op(self):
         # some loss functions and all -> total loss
-        self.loss_function = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=self.y,
-                                                                                    logits=self.read_out_logits))
+        # 每个样本的 loss, 评估时逐 batch 累计, 见 trainer.StreamingEvaluator
+        self.sample_loss = tf.nn.softmax_cross_entropy_with_logits(labels=self.y, logits=self.read_out_logits)
+        self.loss_function = tf.reduce_mean(self.sample_loss)
         # training op
         self.training_op = tf.train.AdamOptimizer(self.learning_rate).minimize(self.loss_function)
         self.predict_op = tf.arg_max(self.read_out_logits, 1)
@@ -324,15 +336,20 @@ class GoogleInceptionV1(object):
         # accuracy metric
         self.accuracy = tf.reduce_mean(tf.cast(predict_matches, tf.float32))
 
-    def train(self, x, y, learning_rate, keep_prob=0.5):
+    def train(self, x, y, learning_rate, keep_prob=0.5, compute_accuracy=True):
         feed_dict = {
-            self.x: x,
-            self.y: y,
             self.keep_prob: keep_prob,
             self.learning_rate: learning_rate
         }
-        _, train_loss = self.sess.run([self.training_op, self.loss_function], feed_dict=feed_dict)
-        train_accuracy = self.get_accuracy(x, y)
+        if x is not None:
+            feed_dict[self.x] = x
+            feed_dict[self.y] = y
+        if not compute_accuracy:
+            _, train_loss = self.sess.run([self.training_op, self.loss_function], feed_dict=feed_dict)
+            return train_loss, None
+        # train accuracy 与训练在同一次 sess.run 中由同一次前向计算得到 (dropout 下, 参数更新前), 不再单独运行一次前向
+        _, train_loss, train_accuracy = self.sess.run([self.training_op, self.loss_function, self.accuracy],
+                                                      feed_dict=feed_dict)
         return train_loss, train_accuracy
 
     def classify(self, features_x):
@@ -349,6 +366,17 @@ class GoogleInceptionV1(object):
         accuracy = self.sess.run(self.accuracy, feed_dict=feed_dict)
         return accuracy
 
+    def evaluate_batch(self, x, y):
+        """
+        返回一个 batch 中每个样本的 loss 和预测的类别
+        """
+        feed_dict = {
+            self.x: x,
+            self.y: y,
+            self.keep_prob: 1.0
+        }
+        return self.sess.run([self.sample_loss, self.predict_op], feed_dict=feed_dict)
+
     def init(self):
         self.build_inception_v1()
         self.init_train_test_op()
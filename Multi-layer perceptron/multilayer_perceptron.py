@@ -11,8 +11,9 @@ from __future__ import absolute_import, division, print_function
 
 import numpy as np
 import tensorflow as tf
-from tensorflow.examples.tutorials.mnist import input_data
 
+import tfutil
+from datautil import read_mnist
 from utils import mnist_dir
 
 
@@ -21,12 +22,17 @@ class MultilayerPerceptron(object):
     multilayer perceptron model
     """
 
-    def __init__(self, layer_size, activation_fun):
+    def __init__(self, layer_size, activation_fun, input_tensors=None, batch_size=None):
         """
         :param layer_size: [input_layer,[hidden_layer], output_layer]
+        :param input_tensors: 输入流水线的 (images, labels) tensor, 不 feed x、y 时从中读取 batch,
+                              见 tfutil.dataset_input_pipeline
+        :param batch_size: 静态的 batch 维度, None 为动态; 设置后 feed 的每个 batch 都必须是该大小
         """
         self.layer_size = layer_size
         self.activation_fun = activation_fun
+        self.input_tensors = input_tensors
+        self.batch_size = batch_size
 
     def create_weight_variable(self, shape, name):
         initial = tf.truncated_normal(shape, stddev=0.01)
@@ -45,8 +51,9 @@ class MultilayerPerceptron(object):
         output_layer_size = self.layer_size[2]
 
         # input features
-        self.x = tf.placeholder(tf.float32, shape=[None, input_layer_size], name='input_layer')
-        self.y = tf.placeholder(tf.float32, [None, output_layer_size], name='output_layer')
+        input_x, input_y = self.input_tensors or (None, None)
+        self.x = tfutil.input_placeholder(tf.float32, [self.batch_size, input_layer_size], 'input_layer', input_x)
+        self.y = tfutil.input_placeholder(tf.float32, [self.batch_size, output_layer_size], 'output_layer', input_y)
 
         # dropout
         self.keep_prob = tf.placeholder(tf.float32)
@@ -100,14 +107,15 @@ class MultilayerPerceptron(object):
 
     def train(self, features_x, y, learning_rate, keep_prob=0.8):
         """
-        训练
+        训练, features_x、y 为 None 时从输入流水线 (input_tensors) 读取 batch
         """
         feed_dict = {
-            self.x: features_x,
-            self.y: y,
             self.keep_prob: keep_prob,
             self.learning_rate: learning_rate
         }
+        if features_x is not None:
+            feed_dict[self.x] = features_x
+            feed_dict[self.y] = y
         _, loss = self.sess.run([self.training_op, self.loss_function], feed_dict=feed_dict)
         return loss
 
@@ -133,7 +141,7 @@ class MultilayerPerceptron(object):
 
 def main():
     print('load datas...')
-    mnist = input_data.read_data_sets(mnist_dir, one_hot=True)
+    mnist = read_mnist(mnist_dir)
 
     # Parameters
     learning_rate = 0.001
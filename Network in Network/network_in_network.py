@@ -17,18 +17,27 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
 
+import tfutil
+
 
 class NetworkInNetwork(object):
     """
     Network in Network(NIN) model
     """
 
-    def __init__(self, input_height, input_width, input_channels, num_classes, activation=tf.nn.relu):
+    def __init__(self, input_height, input_width, input_channels, num_classes, activation=tf.nn.relu,
+                 input_storage='bgr_float16', input_tensors=None, batch_size=None):
         self.input_height = input_height
         self.input_width = input_width
         self.input_channels = input_channels
         self.num_classes = num_classes
         self.activation = activation
+        # 输入图片的存储格式, uint8 格式在图中减均值, 见 tfutil.image_input_layer
+        self.input_storage = input_storage
+        # 输入流水线的 (images, labels) tensor, 不 feed x、y 时从中读取 batch, 见 tfutil.dataset_input_pipeline
+        self.input_tensors = input_tensors
+        # 静态的 batch 维度, None 为动态; 设置后 feed 的每个 batch 都必须是该大小, 见 DataWapper 的 last_batch
+        self.batch_size = batch_size
 
     def create_weight_variable(self, shape, name):
         initial = tf.truncated_normal(shape, stddev=0.01)
@@ -70,9 +79,11 @@ class NetworkInNetwork(object):
 
     def build_nin_model(self):
         # input features
-        self.x = tf.placeholder(tf.float32, shape=[None, self.input_height, self.input_width, self.input_channels],
-                                name='input_layer')
-        self.y = tf.placeholder(tf.float32, [None, self.num_classes], name='output_layer')
+        input_x, input_y = self.input_tensors or (None, None)
+        self.x, input_images = tfutil.image_input_layer(self.input_height, self.input_width, self.input_storage,
+                                                        channels=self.input_channels, input_tensor=input_x,
+                                                        batch_size=self.batch_size)
+        self.y = tfutil.input_placeholder(tf.float32, [self.batch_size, self.num_classes], 'output_layer', input_y)
 
         # learning_rate placeholder
         self.learning_rate = tf.placeholder(tf.float32, name='learning_rate')
@@ -80,7 +91,7 @@ class NetworkInNetwork(object):
         self.keep_prob = tf.placeholder(tf.float32, name='keep_prob')
         print('x:' + str(self.x.get_shape().as_list()))
 
-        self.nin_lay_1 = self.mlp_conv(self.x, kernel_size=11, stride=2, num_filters=96,
+        self.nin_lay_1 = self.mlp_conv(input_images, kernel_size=11, stride=2, num_filters=96,
                                        micro_layer_size=[96, 96], name='nin_lay_1')
         # add dropout
         dropout = slim.dropout(self.nin_lay_1, keep_prob=self.keep_prob)
@@ -114,8 +125,9 @@ class NetworkInNetwork(object):
 
     def init_train_test_op(self):
         # some loss functions and all -> total loss
-        self.loss_function = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=self.y,
-                                                                                    logits=self.read_out_logits))
+        # 每个样本的 loss, 评估时逐 batch 累计, 见 trainer.StreamingEvaluator
+        self.sample_loss = tf.nn.softmax_cross_entropy_with_logits(labels=self.y, logits=self.read_out_logits)
+        self.loss_function = tf.reduce_mean(self.sample_loss)
         # training op
         self.training_op = tf.train.AdamOptimizer(self.learning_rate).minimize(self.loss_function)
         self.predict_op = tf.arg_max(self.read_out_logits, 1)
@@ -125,15 +137,20 @@ class NetworkInNetwork(object):
         # accuracy metric
         self.accuracy = tf.reduce_mean(tf.cast(predict_matches, tf.float32))
 
-    def train(self, x, y, learning_rate, keep_prob=0.5):
+    def train(self, x, y, learning_rate, keep_prob=0.5, compute_accuracy=True):
         feed_dict = {
-            self.x: x,
-            self.y: y,
             self.keep_prob: keep_prob,
             self.learning_rate: learning_rate
         }
-        _, train_loss = self.sess.run([self.training_op, self.loss_function], feed_dict=feed_dict)
-        train_accuracy = self.get_accuracy(x, y)
+        if x is not None:
+            feed_dict[self.x] = x
+            feed_dict[self.y] = y
+        if not compute_accuracy:
+            _, train_loss = self.sess.run([self.training_op, self.loss_function], feed_dict=feed_dict)
+            return train_loss, None
+        # train accuracy 与训练在同一次 sess.run 中由同一次前向计算得到 (dropout 下, 参数更新前), 不再单独运行一次前向
+        _, train_loss, train_accuracy = self.sess.run([self.training_op, self.loss_function, self.accuracy],
+                                                      feed_dict=feed_dict)
         return train_loss, train_accuracy
 
     def classify(self, features_x):
@@ -150,6 +167,17 @@ class NetworkInNetwork(object):
         accuracy = self.sess.run(self.accuracy, feed_dict=feed_dict)
         return accuracy
 
+    def evaluate_batch(self, x, y):
+        """
+        返回一个 batch 中每个样本的 loss 和预测的类别
+        """
+        feed_dict = {
+            self.x: x,
+            self.y: y,
+            self.keep_prob: 1.0
+        }
+        return self.sess.run([self.sample_loss, self.predict_op], feed_dict=feed_dict)
+
     def init(self):
         self.build_nin_model()
         self.init_train_test_op()
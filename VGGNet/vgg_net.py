@@ -16,17 +16,28 @@ from __future__ import absolute_import, division, print_function
 import numpy as np
 import tensorflow as tf
 
+import tfutil
+
 
 class Vgg16(object):
     """
     VggNet-16
     """
 
-    def __init__(self, num_classes, activation, skip_layer, weights_path='DEFAULT'):
+    def __init__(self, num_classes, activation, skip_layer, weights_path='DEFAULT', input_storage='bgr_float16',
+                 input_tensors=None, batch_size=None, head_training=False):
         self.NUM_CLASSES = num_classes
         self.ACTIVATION = activation
+        # 输入图片的存储格式, uint8 格式在图中减均值, 见 tfutil.image_input_layer
+        self.INPUT_STORAGE = input_storage
+        # 输入流水线的 (images, labels) tensor, 不 feed x、y 时从中读取 batch, 见 tfutil.dataset_input_pipeline
+        self.INPUT_TENSORS = input_tensors
+        # 静态的 batch 维度, None 为动态; 设置后 feed 的每个 batch 都必须是该大小, 见 DataWapper 的 last_batch
+        self.BATCH_SIZE = batch_size
         # 指定跳过加载 pre-trained weight 层
         self.SKIP_LAYER = skip_layer
+        # 是否创建只训练 SKIP_LAYER 的 head_training_op (及其 Adam 变量), 见 train_head
+        self.HEAD_TRAINING = head_training
         if weights_path == 'DEFAULT':
             self.WEIGHTS_PATH = 'vgg16.npy'
         else:
@@ -99,8 +110,10 @@ class Vgg16(object):
         构建模型
         """
         # input features
-        self.x = tf.placeholder(tf.float32, shape=[None, 224, 224, 3], name='input_layer')
-        self.y = tf.placeholder(tf.float32, [None, self.NUM_CLASSES], name='output_layer')
+        input_x, input_y = self.INPUT_TENSORS or (None, None)
+        self.x, input_images = tfutil.image_input_layer(224, 224, self.INPUT_STORAGE, input_tensor=input_x,
+                                                        batch_size=self.BATCH_SIZE)
+        self.y = tfutil.input_placeholder(tf.float32, [self.BATCH_SIZE, self.NUM_CLASSES], 'output_layer', input_y)
 
         # learning_rate placeholder
         self.learning_rate = tf.placeholder(tf.float32, name='learning_rate')
@@ -109,7 +122,7 @@ class Vgg16(object):
 
         # build model
         # conv1: conv1_1 + conv1_2 + pool1
-        conv1_1 = self.conv2d(self.x, 3, 3, 64, 1, 1, padding='SAME', name='conv1_1')
+        conv1_1 = self.conv2d(input_images, 3, 3, 64, 1, 1, padding='SAME', name='conv1_1')
         conv1_2 = self.conv2d(conv1_1, 3, 3, 64, 1, 1, padding='SAME', name='conv1_2')
         pool1 = self.max_pool(conv1_2, 3, 3, 2, 2, padding='SAME', name='pool1')
 
@@ -139,6 +152,8 @@ class Vgg16(object):
         # fc6
         fc6 = self.fully_connected(pool5, 4096, name='fc6')
         dropout6 = self.dropout(fc6, self.keep_prob)
+        # 可以直接 feed 的中间层输出, feed 时不再计算之前的层, 见 train_head 和 trainer.build_bottleneck_cache
+        self.BOTTLENECKS = {'pool5': pool5, 'fc6': fc6}
         # fc7
         fc7 = self.fully_connected(dropout6, 4096, name='fc7')
         dropout7 = self.dropout(fc7, self.keep_prob)
@@ -149,10 +164,18 @@ class Vgg16(object):
 
     def init_train_test_op(self):
         # loss function
-        self.loss_function = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=self.y,
-                                                                                    logits=self.read_out_logits))
+        # 每个样本的 loss, 评估时逐 batch 累计, 见 trainer.StreamingEvaluator
+        self.sample_loss = tf.nn.softmax_cross_entropy_with_logits(labels=self.y, logits=self.read_out_logits)
+        self.loss_function = tf.reduce_mean(self.sample_loss)
         # training op
         self.training_op = tf.train.AdamOptimizer(self.learning_rate).minimize(self.loss_function)
+        # 只训练 SKIP_LAYER 中的层 (head), 其余的层冻结, 见 train_head
+        self.HEAD_VARIABLES = [variable for variable in tf.trainable_variables()
+                               if variable.name.split('/')[0] in self.SKIP_LAYER]
+        self.head_training_op = None
+        if self.HEAD_TRAINING and self.HEAD_VARIABLES:
+            self.head_training_op = tf.train.AdamOptimizer(self.learning_rate).minimize(
+                self.loss_function, var_list=self.HEAD_VARIABLES)
         self.predict_op = tf.arg_max(self.read_out_logits, 1)
         # predict
         predict_matches = tf.equal(tf.arg_max(self.y, dimension=1),
@@ -168,18 +191,24 @@ class Vgg16(object):
         predict_y, prob = self.sess.run([self.predict_op, self.read_out_logits], feed_dict=feed_dict)
         return predict_y, prob
 
-    def train(self, x, y, learning_rate, keep_prob=0.5):
+    def train(self, x, y, learning_rate, keep_prob=0.5, compute_accuracy=True):
         """
-        训练
+        训练, x、y 为 None 时从输入流水线 (input_tensors) 读取 batch.
+        compute_accuracy=False 时不计算 train accuracy, 返回 (train_loss, None)
         """
         feed_dict = {
-            self.x: x,
-            self.y: y,
             self.keep_prob: keep_prob,
             self.learning_rate: learning_rate
         }
-        _, train_loss = self.sess.run([self.training_op, self.loss_function], feed_dict=feed_dict)
-        train_accuracy = self.get_accuracy(x, y)
+        if x is not None:
+            feed_dict[self.x] = x
+            feed_dict[self.y] = y
+        if not compute_accuracy:
+            _, train_loss = self.sess.run([self.training_op, self.loss_function], feed_dict=feed_dict)
+            return train_loss, None
+        # train accuracy 与训练在同一次 sess.run 中由同一次前向计算得到 (dropout 下, 参数更新前), 不再单独运行一次前向
+        _, train_loss, train_accuracy = self.sess.run([self.training_op, self.loss_function, self.accuracy],
+                                                      feed_dict=feed_dict)
         return train_loss, train_accuracy
 
     def get_accuracy(self, x, y):
@@ -194,6 +223,54 @@ class Vgg16(object):
         accuracy = self.sess.run(self.accuracy, feed_dict=feed_dict)
         return accuracy
 
+    def evaluate_batch(self, x, y):
+        """
+        返回一个 batch 中每个样本的 loss 和预测的类别
+        """
+        feed_dict = {
+            self.x: x,
+            self.y: y,
+            self.keep_prob: 1.0
+        }
+        return self.sess.run([self.sample_loss, self.predict_op], feed_dict=feed_dict)
+
+    def bottleneck(self, x, layer):
+        """
+        一个 batch 在 layer (BOTTLENECKS 中的层) 的输出
+        """
+        return self.sess.run(self.BOTTLENECKS[layer], feed_dict={self.x: x, self.keep_prob: 1.0})
+
+    def train_head(self, features, y, layer, learning_rate, keep_prob=0.5, compute_accuracy=True):
+        """
+        feed layer 的输出 features, 只训练 head, 不计算 layer 之前冻结的层; 返回值同 train.
+        layer 及之前的层必须不在 SKIP_LAYER 中, 模型需以 head_training=True 创建
+        """
+        if self.head_training_op is None:
+            raise ValueError('train_head needs a model created with head_training=True and a non-empty skip_layer')
+        feed_dict = {
+            self.BOTTLENECKS[layer]: features,
+            self.y: y,
+            self.keep_prob: keep_prob,
+            self.learning_rate: learning_rate
+        }
+        if not compute_accuracy:
+            _, train_loss = self.sess.run([self.head_training_op, self.loss_function], feed_dict=feed_dict)
+            return train_loss, None
+        _, train_loss, train_accuracy = self.sess.run([self.head_training_op, self.loss_function, self.accuracy],
+                                                      feed_dict=feed_dict)
+        return train_loss, train_accuracy
+
+    def evaluate_head_batch(self, features, y, layer):
+        """
+        与 evaluate_batch 相同, 输入为 layer 的输出
+        """
+        feed_dict = {
+            self.BOTTLENECKS[layer]: features,
+            self.y: y,
+            self.keep_prob: 1.0
+        }
+        return self.sess.run([self.sample_loss, self.predict_op], feed_dict=feed_dict)
+
     def init(self):
         self.build_model()
         self.init_train_test_op()
@@ -5,137 +5,1991 @@
 @author: MarkLiu
 @time  : 17-3-6 上午11:38
 """
+import argparse
+import ctypes
+import gzip
+import hashlib
+import multiprocessing
+import os
+import shutil
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+
 import h5py
 import numpy as np
 import progressbar as pbar
 from PIL import Image
-from tensorflow.examples.tutorials.mnist import input_data
-import sys
+
+try:
+    from itertools import izip_longest
+except ImportError:
+    from itertools import zip_longest as izip_longest
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 import utils
 
-imagenet_mean = {'R': np.float16(103.939), 'G': np.float16(116.779), 'B': np.float16(123.68)}
+imagenet_mean = utils.imagenet_mean
+
+
+last_batch_modes = ('partial', 'drop_last', 'pad_and_mask', 'wrap_around')
+
+
+def check_last_batch(last_batch, shuffle_mode):
+    if last_batch not in last_batch_modes:
+        raise ValueError('Unknown last batch mode %s' % last_batch)
+    if last_batch == 'wrap_around' and shuffle_mode != 'index':
+        # 原地 shuffle 会改写 batch 中上一个 epoch 的行
+        raise ValueError("last_batch='wrap_around' needs shuffle_mode='index'")
+
+
+def row_array(rows):
+    """
+    切片转换为行号数组
+    """
+    if isinstance(rows, slice):
+        return np.arange(rows.start, rows.stop)
+    return rows
+
+
+def permute_inplace(array, permutation):
+    """
+    原地重排 array 的第一维, 结果等价于 array[permutation], 只需要一行数据大小的临时内存
+    """
+    visited = np.zeros(len(permutation), dtype=bool)
+    for start in range(len(permutation)):
+        if visited[start] or permutation[start] == start:
+            continue
+        # 沿置换的环依次移动各行
+        temp = array[start].copy()
+        current = start
+        while True:
+            visited[current] = True
+            source = permutation[current]
+            if source == start:
+                array[current] = temp
+                break
+            array[current] = array[source]
+            current = source
 
 
 class DataWapper(object):
-    def __init__(self, x, y):
+    """
+    shuffle_mode='index': 每个 epoch 结束时只重新生成一个打乱的行号序列, next_batch 按行号取出 batch 中的行,
+        不复制整个数据集
+    shuffle_mode='inplace': 每个 epoch 结束时原地打乱 x、y, 之后 next_batch 返回连续的切片 (x 的视图,
+        在下一个 epoch 开始前有效)
+
+    last_batch 决定 epoch 末尾不足 batch_size 的 batch, 除 'partial' 外每个 batch 都恰好是 batch_size 行,
+    模型可以使用静态的 batch 维度:
+    last_batch='partial': 返回较短的 batch
+    last_batch='drop_last': 丢弃剩余的行, 直接从下一个 epoch 开始
+    last_batch='pad_and_mask': 用 batch 第一行补齐, next_batch 返回 (x, y, mask), 填充行的 mask 为 0,
+        适用于评估/推理时用 mask 丢弃填充行的结果
+    last_batch='wrap_around': 用下一个 epoch 开头的行补齐, 只支持 shuffle_mode='index'
+
+    indices 指定 x、y 中属于该数据集的行, train/validation/k-fold 等划分只是同一份数据上的不同行号集合
+    (见 split_indices、kfold_indices), 不复制数据.
+    """
+
+    def __init__(self, x, y, shuffle_mode='index', last_batch='partial', indices=None):
+        if shuffle_mode not in ('index', 'inplace'):
+            raise ValueError('Unknown shuffle mode %s' % shuffle_mode)
+        if indices is not None and shuffle_mode != 'index':
+            # 原地 shuffle 会打乱其他划分的行
+            raise ValueError("indices needs shuffle_mode='index'")
+        check_last_batch(last_batch, shuffle_mode)
         self.x = x
         self.y = y
+        self.shuffle_mode = shuffle_mode
+        self.last_batch = last_batch
         self.pointer = 0
-        self.total_count = self.x.shape[0]
+        self.indices = None if indices is None else np.asarray(indices)
+        self.total_count = self.x.shape[0] if indices is None else len(self.indices)
+        # 当前 epoch 的读取顺序, None 表示按原有顺序
+        self.index = self.indices
 
     def shuffle(self):
         shuffled_index = np.arange(0, self.total_count)
         np.random.shuffle(shuffled_index)
-        self.x = self.x[shuffled_index]
-        self.y = self.y[shuffled_index]
+        if self.shuffle_mode == 'inplace':
+            permute_inplace(self.x, shuffled_index)
+            permute_inplace(self.y, shuffled_index)
+        elif self.indices is not None:
+            self.index = self.indices[shuffled_index]
+        else:
+            self.index = shuffled_index
 
-    def next_batch(self, batch_size):
-        end = self.pointer + batch_size
-        if end > self.total_count:
-            end = self.total_count
+    def epoch_rows(self, start, end):
+        """
+        当前 epoch 读取顺序中 [start, end) 的行: 切片或行号数组
+        """
+        if self.index is None:
+            return slice(start, end)
+        return self.index[start: end]
 
-        batch_x = self.x[self.pointer: end]
-        batch_y = self.y[self.pointer: end]
+    def next_rows(self, batch_size):
+        """
+        推进 pointer, 返回下一个 batch 在 x 中的行: 切片或行号数组.
+        一个 epoch 结束后, 在下一次调用时才重新 shuffle, 因此之前返回的切片在本 epoch 内保持有效.
+        """
+        if self.last_batch in ('drop_last', 'wrap_around') and batch_size > self.total_count:
+            raise ValueError('batch_size %d is larger than the %d rows of the data' % (batch_size, self.total_count))
+        remaining = self.total_count - self.pointer
+        if remaining == 0 or (self.last_batch == 'drop_last' and remaining < batch_size):
+            self.shuffle()
+            self.pointer = 0
 
+        start = self.pointer
+        end = min(start + batch_size, self.total_count)
+        rows = self.epoch_rows(start, end)
         self.pointer = end
 
-        if self.pointer == self.total_count:
+        short = batch_size - (end - start)
+        if short > 0 and self.last_batch == 'pad_and_mask':
+            # 行号 -1 表示填充行, 由 take_batch 处理
+            rows = np.concatenate([row_array(rows), np.full(short, -1, dtype=np.int64)])
+        elif short > 0 and self.last_batch == 'wrap_around':
             self.shuffle()
-            self.pointer = 0
+            rows = np.concatenate([row_array(rows), row_array(self.epoch_rows(0, short))])
+            self.pointer = short
+        return rows
+
+    def take(self, rows):
+        """
+        取出 next_rows 返回的行, 行号数组只复制 batch 中的行
+        """
+        if isinstance(rows, slice):
+            return self.x[rows], self.y[rows]
+        return np.take(self.x, rows, axis=0), np.take(self.y, rows, axis=0)
+
+    def take_into(self, rows, out_x, out_y):
+        """
+        与 take 相同, 结果写入预先分配的 out_x、out_y 的前几行, 不分配新的数组, 返回行数
+        """
+        if isinstance(rows, slice):
+            count = rows.stop - rows.start
+            out_x[:count] = self.x[rows]
+            out_y[:count] = self.y[rows]
+        else:
+            count = len(rows)
+            # mode='raise' 时 numpy 会先写入临时数组再复制到 out, 行号由 next_rows 生成, 不会越界
+            np.take(self.x, rows, axis=0, out=out_x[:count], mode='clip')
+            np.take(self.y, rows, axis=0, out=out_y[:count], mode='clip')
+        return count
+
+    def take_batch(self, rows):
+        """
+        取出 next_rows 返回的 batch, last_batch='pad_and_mask' 时返回 (x, y, mask)
+        """
+        if self.last_batch != 'pad_and_mask':
+            return self.take(rows)
+        mask = row_array(rows) >= 0
+        if not isinstance(rows, slice):
+            rows = np.where(mask, rows, rows[0])
+        return tuple(self.take(rows)) + (mask.astype(np.float32),)
+
+    def take_batch_into(self, rows, out):
+        """
+        与 take_batch 相同, 结果写入预先分配的 out=(x, y[, mask]), 返回 out 的视图, 见 allocate_batch_buffers
+        """
+        if self.last_batch != 'pad_and_mask':
+            count = self.take_into(rows, out[0], out[1])
+            return out[0][:count], out[1][:count]
+        mask = row_array(rows) >= 0
+        if not isinstance(rows, slice):
+            rows = np.where(mask, rows, rows[0])
+        count = self.take_into(rows, out[0], out[1])
+        out[2][:count] = mask
+        return tuple(array[:count] for array in out)
+
+    def next_batch(self, batch_size):
+        return self.take_batch(self.next_rows(batch_size))
+
+    def state(self):
+        """
+        读取位置和当前 epoch 的读取顺序, 保存到 checkpoint 后由 restore_state 恢复, 从下一个 batch 继续读取.
+        shuffle 生成新的行号数组而不修改原有的数组, 因此返回的 index 不需要复制.
+        shuffle_mode='inplace' 的读取顺序保存在 x、y 本身中, 不支持
+        """
+        if self.shuffle_mode == 'inplace':
+            raise ValueError("state needs shuffle_mode='index'")
+        return {'pointer': self.pointer, 'index': self.index}
+
+    def restore_state(self, state):
+        index = state['index']
+        if index is not None and len(index) != self.total_count:
+            raise ValueError('state has %d rows, the data has %d' % (len(index), self.total_count))
+        self.pointer = int(state['pointer'])
+        self.index = None if index is None else np.asarray(index)
+
+    def iter_batches(self, batch_size):
+        """
+        按行的顺序逐个产生覆盖整个数据集的 (x, y), 最后一个 batch 可能较短, 用于完整的评估;
+        不影响 next_batch 的读取位置
+        """
+        for start in range(0, self.total_count, batch_size):
+            end = min(start + batch_size, self.total_count)
+            yield self.take(slice(start, end) if self.indices is None else self.indices[start: end])
+
+
+class HDF5DataWapper(DataWapper):
+    """
+    基于打开的 h5py dataset 的 DataWapper, 不把整个数据集读入内存, next_batch 时只读取 batch 中的行.
+    shuffle 按 chunk 对齐的数据块进行: 先打乱数据块的顺序, 再打乱数据块内部的顺序, 一个 batch 只涉及
+    一到两个数据块, 数据块被顺序地整块读取并缓存, 每个 epoch 每个数据块只读取一次.
+    train/validation 划分为同一个文件上的 [start, end) 行区间, 或者 indices 指定的行号集合.
+    """
+
+    def __init__(self, x, y, start=0, end=None, block_size=None, last_batch='partial', indices=None):
+        """
+        :param x: h5py dataset, 如 data['images']
+        :param y: labels, 划分覆盖的行区间会被读入内存
+        :param block_size: 数据块的行数, 默认为 x 的 HDF5 chunk 行数
+        :param last_batch: epoch 末尾不足 batch_size 的 batch 的处理方式, 见 DataWapper
+        :param indices: 划分包含的行号, 指定时忽略 start、end
+        """
+        check_last_batch(last_batch, 'index')
+        if indices is None:
+            end = x.shape[0] if end is None else end
+            indices = np.arange(start, end)
+        # 排序后同一数据块中的行相邻
+        self.indices = np.unique(indices)
+        self.x = x
+        self.start = int(self.indices[0])
+        self.end = int(self.indices[-1]) + 1
+        self.y = y[self.start: self.end]
+        self.shuffle_mode = 'index'
+        self.last_batch = last_batch
+        self.pointer = 0
+        self.total_count = len(self.indices)
+        if block_size is None:
+            block_size = x.chunks[0] if x.chunks is not None else 1000
+        self.block_size = block_size
+        # 当前 epoch 的读取顺序, x 中的绝对行号
+        self.index = self.indices
+        self.cached_block = None
+        self.cached_block_id = None
+        self.read_lock = threading.Lock()
+
+    def shuffle(self):
+        # 数据块与 HDF5 chunk 对齐: 第 i 块为 [i * block_size, (i + 1) * block_size) 中属于该划分的行
+        block_ids = self.indices // self.block_size
+        blocks = np.split(self.indices.copy(), np.flatnonzero(np.diff(block_ids)) + 1)
+        for block in blocks:
+            np.random.shuffle(block)
+        np.random.shuffle(blocks)
+        self.index = np.concatenate(blocks)
+
+    def read_block(self, block_id):
+        """
+        读取并缓存一个数据块, 返回 (数据块, 数据块第一行的行号)
+        """
+        block_start = max(block_id * self.block_size, self.start)
+        if self.cached_block_id != block_id:
+            self.cached_block = self.x[block_start: min((block_id + 1) * self.block_size, self.end)]
+            self.cached_block_id = block_id
+        return self.cached_block, block_start
+
+    def read_rows(self, rows, out=None):
+        """
+        按顺序读取 x 的若干行, 写入 out (默认新分配)
+        """
+        batch_x = np.empty((len(rows),) + self.x.shape[1:], dtype=self.x.dtype) if out is None else out
+        block_ids = rows // self.block_size
+        # 按出现的先后顺序读取数据块, 跨块的 batch 结束时缓存的是下一个 batch 所在的数据块
+        _, first_index = np.unique(block_ids, return_index=True)
+        for block_id in block_ids[np.sort(first_index)]:
+            mask = block_ids == block_id
+            block, block_start = self.read_block(block_id)
+            batch_x[mask] = block[rows[mask] - block_start]
+        return batch_x
+
+    def take(self, rows):
+        # 数据块缓存不是线程安全的
+        with self.read_lock:
+            batch_x = self.read_rows(rows)
+        return batch_x, self.y[rows - self.start]
+
+    def take_into(self, rows, out_x, out_y):
+        count = len(rows)
+        with self.read_lock:
+            self.read_rows(rows, out_x[:count])
+        np.take(self.y, rows - self.start, axis=0, out=out_y[:count], mode='clip')
+        return count
 
-        return batch_x, batch_y
+
+def split_indices(count, train_split, seed=None, shuffle=True):
+    """
+    划分 train/validation, 返回两个排好序的行号数组
+    :param train_split: train 所占的比例
+    :param seed: 随机数种子, None 时使用 np.random
+    :param shuffle: False 时按顺序划分, 前 train_split 的行为 train, 各自是连续的行区间
+    """
+    train_samples = int(count * train_split)
+    if not shuffle:
+        return np.arange(train_samples), np.arange(train_samples, count)
+    random_state = np.random.RandomState(seed) if seed is not None else np.random
+    permutation = random_state.permutation(count)
+    return np.sort(permutation[:train_samples]), np.sort(permutation[train_samples:])
+
+
+def kfold_indices(count, folds, seed=None):
+    """
+    k-fold 划分, 返回 folds 个 (train, validation) 行号数组
+    """
+    random_state = np.random.RandomState(seed) if seed is not None else np.random
+    parts = np.array_split(random_state.permutation(count), folds)
+    return [(np.sort(np.concatenate(parts[:k] + parts[k + 1:])), np.sort(parts[k])) for k in range(folds)]
+
+
+def save_splits(path, count, **splits):
+    """
+    保存划分的行号数组, 如 save_splits(path, count, train=train_index, validation=validate_index)
+    :param count: 数据集的总行数, 读取时用于检查划分是否属于同一个数据集
+    """
+    np.savez(path, count=count, **splits)
+
+
+def load_splits(path, count=None):
+    """
+    读取 save_splits 保存的划分, 返回 {名称: 行号数组}
+    """
+    with np.load(path) as f:
+        splits = dict((name, f[name]) for name in f.files)
+    saved_count = int(splits.pop('count'))
+    if count is not None and saved_count != count:
+        raise ValueError('Split file %s is for %d rows, the data has %d' % (path, saved_count, count))
+    return splits
+
+
+def load_or_create_split(path, count, train_split, seed=None, shuffle=False):
+    """
+    读取 path 中保存的 train/validation 划分, 文件不存在时划分并保存, 使不同的运行使用相同的划分.
+    默认按顺序划分 (前 train_split 的行为 train), 与之前的 finetune 脚本一致, HDF5 的读取也集中在连续的 chunk 上
+    :param shuffle: True 时随机划分, 见 split_indices
+    :return: (train, validation) 行号数组
+    """
+    if os.path.exists(path):
+        splits = load_splits(path, count)
+        # 没有记录 shuffle 的文件是之前随机划分保存的
+        saved_shuffle = bool(splits.pop('shuffle', True))
+        if len(splits['train']) != int(count * train_split) or saved_shuffle != shuffle:
+            raise ValueError('Split file %s has %d %s train rows, train_split %.2f needs %d %s rows, '
+                             'remove it to resplit' % (path, len(splits['train']),
+                                                       'random' if saved_shuffle else 'sequential', train_split,
+                                                       int(count * train_split), 'random' if shuffle else 'sequential'))
+        return splits['train'], splits['validation']
+    train_index, validate_index = split_indices(count, train_split, seed, shuffle=shuffle)
+    save_splits(path, count, train=train_index, validation=validate_index, shuffle=shuffle)
+    return train_index, validate_index
+
+
+def allocate_batch_buffers(data, batch_size, count):
+    """
+    按 data 的 batch 格式 (x, y[, mask]) 预先分配 count 组 batch_size 行的连续数组, 供 take_batch_into 写入
+    """
+    probe = data.take_batch(data.epoch_rows(0, 1))
+    return [tuple(np.empty((batch_size,) + array.shape[1:], dtype=array.dtype) for array in probe)
+            for _ in range(count)]
+
+
+class BatchRingDataWapper(object):
+    """
+    预先分配 capacity 组连续的 batch 数组循环使用, next_batch 用 np.take(..., out=) 将 batch 直接写入其中,
+    训练时不再每步分配、释放数十 MB 的数组, 内存占用和 page fault 保持平稳.
+    返回的 batch 是 buffer 的视图, 在 release 之前有效; auto_release=True 时没有空闲的 buffer 则自动
+    release 最早的 batch, 即每个 batch 在之后的 capacity - 1 次 next_batch 中保持有效.
+    """
+
+    def __init__(self, data, batch_size, capacity=2, auto_release=True):
+        """
+        :param data: DataWapper 及其子类
+        :param batch_size: 每个 batch 的大小, next_batch 只接受该 batch_size
+        """
+        self.data = data
+        self.batch_size = batch_size
+        self.auto_release = auto_release
+        self.buffers = allocate_batch_buffers(data, batch_size, capacity)
+        self.free_slots = deque(range(capacity))
+        self.held_slots = deque()
+
+    @property
+    def total_count(self):
+        return self.data.total_count
+
+    def next_batch(self, batch_size):
+        if batch_size != self.batch_size:
+            raise ValueError('BatchRingDataWapper prepares batches of size %d, got %d' %
+                             (self.batch_size, batch_size))
+        if not self.free_slots:
+            if not self.auto_release:
+                raise RuntimeError('all %d batch buffers are in use, release a batch first' % len(self.buffers))
+            self.release()
+        slot = self.free_slots.popleft()
+        batch = self.data.take_batch_into(self.data.next_rows(batch_size), self.buffers[slot])
+        self.held_slots.append(slot)
+        return batch
+
+    def release(self):
+        """
+        归还最早返回的 batch 的 buffer, 之后该 batch 的内容会被覆盖
+        """
+        self.free_slots.append(self.held_slots.popleft())
+
+    def close(self):
+        if hasattr(self.data, 'close'):
+            self.data.close()
+
+
+def iter_batches(datas, batch_size):
+    """
+    按行的顺序逐个产生覆盖整个数据集的 (x, y) batch
+    :param datas: DataWapper 及其子类, 或者 (x, y), x、y 为 numpy 数组、memmap 或 h5py dataset
+    """
+    if hasattr(datas, 'iter_batches'):
+        return datas.iter_batches(batch_size)
+    x, y = datas
+    return ((x[start: start + batch_size], y[start: start + batch_size]) for start in range(0, x.shape[0], batch_size))
+
+
+def iter_prefetch(iterable, capacity=2):
+    """
+    在后台线程中提前读取 iterable 的 capacity 个元素, 读取与调用者的计算并行
+    """
+    items = queue.Queue(capacity)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stopped.is_set():
+                    return
+                items.put((item, None))
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stopped.set()
+        # 唤醒可能阻塞在 put 上的线程
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+class PrefetchDataWapper(object):
+    """
+    在后台线程中预先准备后续的 batch, 与训练的 sess.run 并行.
+    next_rows 在锁内按顺序执行, take (切片、fancy indexing、resize 等) 由 num_threads 个线程并行执行,
+    batch 按顺序交给调用者, 最多预先准备 capacity 个 batch.
+    reuse_buffers=True 时 batch 写入预先分配的 capacity + 1 组 buffer 循环使用, 返回的 batch 是 buffer 的视图,
+    在下一次 next_batch 之前有效.
+    """
+
+    def __init__(self, data, batch_size, capacity=2, num_threads=1, reuse_buffers=False):
+        """
+        :param data: DataWapper 及其子类
+        :param batch_size: 每个 batch 的大小, next_batch 只接受该 batch_size
+        :param reuse_buffers: 是否复用预先分配的 batch buffer, 见 allocate_batch_buffers
+        """
+        self.data = data
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.num_threads = num_threads
+        # 准备中和已准备好的 batch 最多 capacity 个, 另有一个由调用者持有
+        self.buffers = allocate_batch_buffers(data, batch_size, capacity + 1) if reuse_buffers else None
+        self.free_buffers = deque(range(capacity + 1))
+        self.held_buffer = None
+
+        self.rows_lock = threading.Lock()
+        self.ready = threading.Condition()
+        self.free_slots = threading.Semaphore(capacity)
+        self.batches = {}
+        self.produce_seq = 0
+        self.consume_seq = 0
+        # 每个 batch 读取之前 data 的状态, 见 state
+        self.track_state = data.shuffle_mode == 'index' and hasattr(data, 'state')
+        self.states = {}
+        self.error = None
+        self.stopped = False
+
+        # 统计调用者等待 batch 的次数和时间
+        self.batch_count = 0
+        self.wait_count = 0
+        self.wait_time = 0.
+
+        self.threads = [threading.Thread(target=self._prefetch) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def total_count(self):
+        return self.data.total_count
+
+    def _prefetch(self):
+        try:
+            while True:
+                self.free_slots.acquire()
+                if self.stopped:
+                    return
+                slot = None
+                if self.buffers is not None:
+                    with self.ready:
+                        slot = self.free_buffers.popleft()
+                with self.rows_lock:
+                    seq = self.produce_seq
+                    self.produce_seq += 1
+                    if self.track_state:
+                        self.states[seq] = self.data.state()
+                    rows = self.data.next_rows(self.batch_size)
+                    if self.data.shuffle_mode == 'inplace':
+                        # 原地 shuffle 会改写尚未被使用的切片
+                        batch = self.take_batch(rows, slot, copy=True)
+                if self.data.shuffle_mode != 'inplace':
+                    batch = self.take_batch(rows, slot)
+                with self.ready:
+                    self.batches[seq] = (slot, batch)
+                    self.ready.notify_all()
+        except Exception as e:
+            with self.ready:
+                self.error = e
+                self.ready.notify_all()
+
+    def take_batch(self, rows, slot, copy=False):
+        if slot is not None:
+            return self.data.take_batch_into(rows, self.buffers[slot])
+        batch = self.data.take_batch(rows)
+        if copy:
+            batch = tuple(np.array(array) for array in batch)
+        return batch
+
+    def next_batch(self, batch_size):
+        if batch_size != self.batch_size:
+            raise ValueError('PrefetchDataWapper prepares batches of size %d, got %d' %
+                             (self.batch_size, batch_size))
+        with self.ready:
+            # 上一次返回的 batch 不再使用, 其 buffer 可以复用
+            if self.held_buffer is not None:
+                self.free_buffers.append(self.held_buffer)
+                self.held_buffer = None
+            if self.consume_seq not in self.batches:
+                self.wait_count += 1
+                wait_start = time.time()
+                while self.consume_seq not in self.batches and self.error is None:
+                    self.ready.wait()
+                self.wait_time += time.time() - wait_start
+            if self.error is not None:
+                raise self.error
+            self.held_buffer, batch = self.batches.pop(self.consume_seq)
+            with self.rows_lock:
+                self.states.pop(self.consume_seq, None)
+                self.consume_seq += 1
+        self.batch_count += 1
+        self.free_slots.release()
+        return batch
+
+    def state(self):
+        """
+        调用者尚未取走的第一个 batch 读取之前 data 的状态: 已预取但未返回的 batch 不计入,
+        从该状态恢复后 next_batch 返回的正是下一个 batch, 见 DataWapper.state
+        """
+        if not self.track_state:
+            raise ValueError("state needs a DataWapper with shuffle_mode='index'")
+        with self.rows_lock:
+            state = self.states.get(self.consume_seq)
+            return self.data.state() if state is None else state
+
+    def stats(self):
+        """
+        返回 batch 数目, 调用者等待的次数、比例和总时间
+        """
+        return {'batch_count': self.batch_count,
+                'wait_count': self.wait_count,
+                'wait_ratio': self.wait_count / float(max(self.batch_count, 1)),
+                'wait_time': self.wait_time}
+
+    def close(self):
+        self.stopped = True
+        for _ in self.threads:
+            self.free_slots.release()
+        for thread in self.threads:
+            thread.join()
+
+
+def lanczos_filter(x):
+    """
+    PIL 中 Image.LANCZOS (a=3) 的插值核
+    """
+    x = np.asarray(x, dtype=np.float64)
+    weights = np.sinc(x) * np.sinc(x / 3.0)
+    weights[(x < -3.0) | (x >= 3.0)] = 0.0
+    return weights
+
+
+def resample_matrix(input_size, output_size, precision_bits=22):
+    """
+    计算一维 resize 的插值权重矩阵 [output_size, input_size], 与 PIL 的 resample 实现一致:
+    Lanczos 权重归一化后量化为 precision_bits 位定点整数, 因此 float64 矩阵乘法的结果是精确的整数.
+    """
+    scale = float(input_size) / output_size
+    filter_scale = max(scale, 1.0)
+    support = 3.0 * filter_scale
+
+    matrix = np.zeros((output_size, input_size), dtype=np.float64)
+    for out_i in range(output_size):
+        center = (out_i + 0.5) * scale
+        x_min = max(int(center - support + 0.5), 0)
+        x_max = min(int(center + support + 0.5), input_size)
+        taps = lanczos_filter((np.arange(x_min, x_max) - center + 0.5) / filter_scale)
+        total = taps.sum()
+        if total != 0:
+            taps /= total
+        # 与 PIL 一致: 正数向上取整 0.5, 负数向下
+        taps = np.where(taps < 0, np.trunc(taps * (1 << precision_bits) - 0.5),
+                        np.trunc(taps * (1 << precision_bits) + 0.5))
+        matrix[out_i, x_min:x_max] = taps
+    return matrix
+
+
+def rgb_to_storage(image, storage):
+    """
+    将 resize 后的 RGB uint8 图片 [rows, cols, 3] 转换为 storage 格式, 见 ImageDataTransfer
+    """
+    if storage == 'gray_uint8':
+        return image[:, :, :1]
+    if storage == 'rgb_uint8':
+        return image
+
+    im = np.array(image, dtype=np.float16)
+    im[:, :, 0] -= imagenet_mean['R']
+    im[:, :, 1] -= imagenet_mean['G']
+    im[:, :, 2] -= imagenet_mean['B']
+    # 'RGB'->'BGR', historical reasons in OpenCV
+    im = im[:, :, ::-1]
+    return im
 
 
 class ImageDataTransfer(object):
-    def __init__(self, pre_img_rows, pre_img_cols, pre_images, output_rows, output_cols):
+    """
+    将 mnist 灰度图 resize 为 alexnet/vggnet 的输入: 灰度->RGB, LANCZOS resize, 减均值, RGB->BGR
+
+    engine='pil': 逐张图片调用 PIL, 作为参考实现
+    engine='vectorized': 按 chunk_size 分块, 用预先计算的行/列插值矩阵做矩阵乘法完成 resize,
+        灰度->3通道、减均值、RGB->BGR 都是整块的数组运算. 插值矩阵复现了 PIL 8 位定点 resample
+        (先水平后竖直, 每次都舍入并截断到 [0, 255]), 与 'pil' 的输出误差容限为 0;
+        若所用的 Pillow 版本 resample 实现不同, 像素误差不超过 1 (减均值前的 0~255 尺度).
+
+    storage='bgr_float16': 输出减均值后的 BGR float16 图片, [rows, cols, 3]
+    storage='rgb_uint8': 输出 resize 后的 RGB uint8 图片, [rows, cols, 3], 减均值和 RGB->BGR 由模型在图中完成
+    storage='gray_uint8': 输出 resize 后的单通道 uint8 图片, [rows, cols, 1], 模型在图中扩展为 3 通道
+    """
+
+    def __init__(self, pre_img_rows, pre_img_cols, pre_images, output_rows, output_cols,
+                 engine='vectorized', chunk_size=256, storage='bgr_float16'):
         self.pre_img_rows = pre_img_rows
         self.pre_img_cols = pre_img_cols
         self.pre_images = pre_images
         self.output_rows = output_rows
         self.output_cols = output_cols
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.storage = storage
+        self.precision_bits = 22
+
+        if engine not in ('pil', 'vectorized'):
+            raise ValueError('Unknown transfer engine %s' % engine)
+        if storage not in ('bgr_float16', 'rgb_uint8', 'gray_uint8'):
+            raise ValueError('Unknown storage %s' % storage)
+        channels = 1 if storage == 'gray_uint8' else 3
+        self.output_shape = (output_rows, output_cols, channels)
+        self.output_dtype = np.float16 if storage == 'bgr_float16' else np.uint8
+        if engine == 'vectorized':
+            self.row_matrix = resample_matrix(pre_img_rows, output_rows, self.precision_bits)
+            self.col_matrix = resample_matrix(pre_img_cols, output_cols, self.precision_bits).T
+            # resize 后像素为 0~255 的整数, 减均值和 'RGB'->'BGR' 预先做成查找表: [256, 3] float16
+            bgr_mean = np.array([imagenet_mean['B'], imagenet_mean['G'], imagenet_mean['R']], dtype=np.float32)
+            self.pixel_table = (np.arange(256, dtype=np.float32)[:, np.newaxis] - bgr_mean).astype(np.float16)
+
+    def _round_clip(self, x):
+        """
+        定点数舍入并截断到 uint8 范围
+        """
+        x += 1 << (self.precision_bits - 1)
+        x *= 1.0 / (1 << self.precision_bits)
+        np.floor(x, out=x)
+        return np.clip(x, 0, 255, out=x)
+
+    def transfer_batch(self, images):
+        """
+        对一批原始图片进行向量化的转换
+        :param images: [batch, pre_img_rows * pre_img_cols] 或 [batch, pre_img_rows, pre_img_cols]
+        :return: [batch, output_rows, output_cols, channels], dtype 由 storage 决定
+        """
+        count = images.shape[0]
+        images = np.asarray(images).reshape(count, self.pre_img_rows, self.pre_img_cols)
+        images = images.astype('uint8').astype(np.float64)
+
+        # horizontal pass: [batch * rows, cols] x [cols, output_cols]
+        horizontal = images.reshape(-1, self.pre_img_cols).dot(self.col_matrix)
+        horizontal = self._round_clip(horizontal).reshape(count, self.pre_img_rows, self.output_cols)
+        # vertical pass: [output_rows, rows] x [rows, batch * output_cols]
+        horizontal = horizontal.transpose(1, 0, 2).reshape(self.pre_img_rows, -1)
+        resized = self._round_clip(self.row_matrix.dot(horizontal))
+        resized = resized.reshape(self.output_rows, count, self.output_cols).transpose(1, 0, 2)
+        resized = resized.astype(np.uint8)
+
+        if self.storage == 'gray_uint8':
+            return resized[:, :, :, np.newaxis]
+        if self.storage == 'rgb_uint8':
+            return np.repeat(resized[:, :, :, np.newaxis], 3, axis=3)
+        # 灰度 -> 3 通道, 减均值, 'RGB'->'BGR' 通过一次查表完成
+        return np.take(self.pixel_table, resized, axis=0)
+
+    def transfer_block(self, start, end):
+        """
+        转换 pre_images[start: end]
+        """
+        if self.engine == 'vectorized':
+            return self.transfer_batch(self.pre_images[start: end])
+        return np.array([self._transfer_image_pil(image) for image in self.pre_images[start: end]],
+                        dtype=self.output_dtype)
+
+    def _transfer_image_pil(self, pre_image):
+        image = pre_image.reshape(self.pre_img_rows, self.pre_img_cols)
+        image = image.astype('uint8')
+        im = Image.fromarray(image)  # monochromatic image
+        imrgb = im.convert('RGB')
+        imrgb = imrgb.resize((self.output_rows, self.output_cols), Image.LANCZOS)
+        return rgb_to_storage(np.array(imrgb), self.storage)
 
     def transfer(self):
-        image_reshape = np.ndarray(shape=(self.pre_images.shape[0], self.output_rows, self.output_cols, 3),
-                                   dtype=np.float16)
+        image_reshape = np.ndarray(shape=(self.pre_images.shape[0],) + self.output_shape, dtype=self.output_dtype)
 
         widgets = ['Transfer: ', pbar.Percentage(), ' ', pbar.Bar('>'), ' ', pbar.ETA()]
         image_bar = pbar.ProgressBar(widgets=widgets, maxval=self.pre_images.shape[0]).start()
 
-        for i in range(0, self.pre_images.shape[0]):
-            image = self.pre_images[i].reshape(self.pre_img_rows, self.pre_img_cols)
-            image = image.astype('uint8')
-            im = Image.fromarray(image)  # monochromatic image
-            imrgb = im.convert('RGB')
-            imrgb = imrgb.resize((self.output_rows, self.output_cols), Image.ANTIALIAS)
-
-            im = np.array(imrgb, dtype=np.float16)
-            im[:, :, 0] -= imagenet_mean['R']
-            im[:, :, 1] -= imagenet_mean['G']
-            im[:, :, 2] -= imagenet_mean['B']
-            # 'RGB'->'BGR', historical reasons in OpenCV
-            im = im[:, :, ::-1]
-            image_reshape[i] = im
+        for start in range(0, self.pre_images.shape[0], self.chunk_size):
+            end = min(start + self.chunk_size, self.pre_images.shape[0])
+            image_reshape[start: end] = self.transfer_block(start, end)
 
             # test for correct convert!
-            # if i < 3:
-            #     img = Image.fromarray(np.uint8(im))
-            #     img.save(str(i) + '.jpeg', 'jpeg')
-            image_bar.update(i + 1)
+            # if start == 0:
+            #     img = Image.fromarray(np.uint8(image_reshape[0]))
+            #     img.save('0.jpeg', 'jpeg')
+            image_bar.update(end)
         image_bar.finish()
         print('image_reshape:', image_reshape.shape)
 
         return image_reshape
 
 
-def mnist_reshape(target='alexnet'):
+class HDF5DatasetWriter(object):
     """
-    mnist 数据集进行reshape, target: alexnet、vggnet
+    流式写入 HDF5 数据集: 预先创建可扩展、分块存储的 images/labels 数据集, 转换得到的数据块逐块追加,
+    内存占用只有一个数据块而不是整个数据集
     """
-    print('transform mnist data to ' + target + ' model size...')
-    # translate mnist -> alexnet model, vgg_net model
-    mnist = input_data.read_data_sets(utils.mnist_dir, one_hot=True)
-    images = mnist.train.images * 255
+
+    def __init__(self, path, image_shape, label_shape, image_dtype=np.float16, label_dtype=np.float64,
+                 chunk_rows=100, compression=None, append=False):
+        """
+        :param image_shape: 单张图片的 shape, 如 (224, 224, 3)
+        :param chunk_rows: HDF5 chunk 包含的图片数目, 一般取训练时的 batch_size
+        :param compression: None/'none'、'lzf' 或 'gzip'
+        :param append: True 且 path 已存在时在已有数据之后继续追加
+        """
+        if compression == 'none':
+            compression = None
+        if compression not in (None, 'lzf', 'gzip'):
+            raise ValueError('Unknown compression %s' % compression)
+
+        self.path = path
+        self.count = 0
+        image_shape = tuple(image_shape)
+        label_shape = tuple(label_shape)
+        if append and os.path.exists(path):
+            self.file = h5py.File(path, 'a')
+            self.images = self.file['images']
+            self.labels = self.file['labels']
+            for name, dataset, shape, dtype in [('images', self.images, image_shape, image_dtype),
+                                                ('labels', self.labels, label_shape, label_dtype)]:
+                if dataset.shape[1:] != shape or dataset.dtype != np.dtype(dtype):
+                    self.file.close()
+                    raise ValueError('%s of %s are %r %s, expected %r %s' % (
+                        name, path, dataset.shape[1:], dataset.dtype, shape, np.dtype(dtype)))
+            self.count = min(self.images.shape[0], self.labels.shape[0])
+            return
+        remove_link(path)
+        self.file = h5py.File(path, 'w')
+        self.images = self.file.create_dataset('images', shape=(0,) + image_shape, maxshape=(None,) + image_shape,
+                                               chunks=(chunk_rows,) + image_shape, dtype=image_dtype,
+                                               compression=compression)
+        self.labels = self.file.create_dataset('labels', shape=(0,) + label_shape, maxshape=(None,) + label_shape,
+                                               chunks=(max(chunk_rows, 1024),) + label_shape, dtype=label_dtype,
+                                               compression=compression)
+
+    def append(self, images, labels):
+        """
+        追加一个数据块
+        """
+        end = self.count + images.shape[0]
+        self.images.resize(end, axis=0)
+        self.labels.resize(end, axis=0)
+        self.images[self.count: end] = images
+        self.labels[self.count: end] = labels
+        self.count = end
+
+    def truncate(self, count):
+        """
+        丢弃第 count 行之后的数据
+        """
+        self.images.resize(count, axis=0)
+        self.labels.resize(count, axis=0)
+        self.count = count
+
+    def flush(self):
+        """
+        将已追加的数据写入磁盘, 中断后以 append 方式重新打开时不丢失
+        """
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def remove_link(path):
+    """
+    path 是符号链接 (如指向数据集缓存) 时删除链接本身, 避免新写入的文件覆盖链接指向的缓存文件
+    """
+    if os.path.islink(path):
+        os.remove(path)
+
+
+def memmap_labels_path(path):
+    """
+    memmap 格式中 labels 文件的路径: xxx.npy -> xxx_labels.npy
+    """
+    return os.path.splitext(path)[0] + '_labels.npy'
+
+
+def open_memmap_dataset(path, mode='r'):
+    """
+    以 numpy.memmap 打开 memmap 格式的数据集, 返回 (images, labels)
+    """
+    return np.load(path, mmap_mode=mode), np.load(memmap_labels_path(path), mmap_mode=mode)
+
+
+class MemmapDatasetWriter(object):
+    """
+    流式写入 memmap 格式的数据集: images、labels 分别保存为原始的 .npy 文件 (固定 128 字节的头部 + 连续的数据),
+    可以直接用 numpy.memmap 打开, batch 是零拷贝的视图或 page cache 上的读取, 没有 h5py 的解压和全局锁.
+    数据块逐块追加到文件末尾, 关闭 (或 flush) 时将最终的行数写回头部.
+    """
+    header_size = 128
+
+    def __init__(self, path, image_shape, label_shape, image_dtype=np.float16, label_dtype=np.float64,
+                 append=False):
+        """
+        :param append: True 且 path 已存在时在已有数据之后继续追加
+        """
+        self.path = path
+        self.count = 0
+        self.shapes = [tuple(image_shape), tuple(label_shape)]
+        self.dtypes = [np.dtype(image_dtype), np.dtype(label_dtype)]
+        file_paths = [path, memmap_labels_path(path)]
+        if append and all(os.path.exists(file_path) for file_path in file_paths):
+            self.files = [open(file_path, 'r+b') for file_path in file_paths]
+            counts = []
+            for f, file_path, shape, dtype in zip(self.files, file_paths, self.shapes, self.dtypes):
+                np.lib.format.read_magic(f)
+                header_shape, _, header_dtype = np.lib.format.read_array_header_1_0(f)
+                if header_shape[1:] != shape or header_dtype != dtype:
+                    for opened in self.files:
+                        opened.close()
+                    raise ValueError('%s is %r %s, expected %r %s' % (file_path, header_shape[1:], header_dtype,
+                                                                       shape, dtype))
+                # 头部的行数只在关闭时更新, 中断的写入可能留下不完整的行, 以文件中完整的行数为准
+                f.seek(0, os.SEEK_END)
+                counts.append((f.tell() - self.header_size) // self.row_bytes(shape, dtype))
+            self.truncate(min(counts))
+            return
+        for file_path in file_paths:
+            remove_link(file_path)
+        self.files = [open(file_path, 'wb') for file_path in file_paths]
+        for f, shape, dtype in zip(self.files, self.shapes, self.dtypes):
+            self.write_header(f, (0,) + shape, dtype)
+
+    def row_bytes(self, shape, dtype):
+        return int(np.prod(shape)) * dtype.itemsize
+
+    def write_header(self, f, shape, dtype):
+        """
+        写入 .npy 1.0 格式的头部, 用空格补齐到固定长度, 以便之后原地改写行数
+        """
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            np.lib.format.dtype_to_descr(dtype), shape)
+        header_len = self.header_size - 10
+        if len(header) + 1 > header_len:
+            raise ValueError('Shape %r is too large for the memmap header' % (shape,))
+        f.seek(0)
+        f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', header_len))
+        f.write((header + ' ' * (header_len - len(header) - 1) + '\n').encode('latin1'))
+
+    def append(self, images, labels):
+        """
+        追加一个数据块
+        """
+        for f, array, dtype in zip(self.files, (images, labels), self.dtypes):
+            f.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+        self.count += images.shape[0]
+
+    def truncate(self, count):
+        """
+        丢弃第 count 行之后的数据
+        """
+        for f, shape, dtype in zip(self.files, self.shapes, self.dtypes):
+            f.seek(self.header_size + count * self.row_bytes(shape, dtype))
+            f.truncate()
+        self.count = count
+
+    def flush(self):
+        """
+        将当前的行数写回头部并写入磁盘, 写入过程中文件也可以被打开读取
+        """
+        for f, shape, dtype in zip(self.files, self.shapes, self.dtypes):
+            self.write_header(f, (self.count,) + shape, dtype)
+            f.seek(0, os.SEEK_END)
+            f.flush()
+
+    def close(self):
+        for f, shape, dtype in zip(self.files, self.shapes, self.dtypes):
+            self.write_header(f, (self.count,) + shape, dtype)
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def h5_to_memmap(h5_path, npy_path, block_rows=1000):
+    """
+    将 mnist_reshape 生成的 HDF5 文件逐块转换为 memmap 格式
+    """
+    with h5py.File(h5_path, 'r') as data:
+        images = data['images']
+        labels = data['labels']
+        with MemmapDatasetWriter(npy_path, images.shape[1:], labels.shape[1:],
+                                 image_dtype=images.dtype, label_dtype=labels.dtype) as writer:
+            for start in range(0, images.shape[0], block_rows):
+                end = min(start + block_rows, images.shape[0])
+                writer.append(images[start: end], labels[start: end])
+    print('Convert ' + h5_path + ' to ' + npy_path)
+
+
+def benchmark_batch_throughput(h5_path, npy_path, batch_size=100, batches=100):
+    """
+    比较 HDF5DataWapper 与基于 numpy.memmap 的 DataWapper 读取 shuffle 后的 batch 的速度
+    """
+    results = {}
+    with h5py.File(h5_path, 'r') as data:
+        images, labels = open_memmap_dataset(npy_path)
+        for name, datas in [('h5py', HDF5DataWapper(data['images'], data['labels'])),
+                            ('memmap', DataWapper(images, labels))]:
+            datas.shuffle()
+            start = time.time()
+            for _ in range(batches):
+                batch_x, batch_y = datas.next_batch(batch_size)
+            results[name] = batches * batch_size / (time.time() - start)
+            print('%s: %.1f images/sec' % (name, results[name]))
+    return results
+
+
+# idx 文件中数据类型的编码, 见 http://yann.lecun.com/exdb/mnist/
+idx_dtypes = {0x08: np.uint8, 0x09: np.int8, 0x0B: '>i2', 0x0C: '>i4', 0x0D: '>f4', 0x0E: '>f8'}
+
+
+def read_idx(path):
+    """
+    解析 (gzip 压缩的) idx 格式文件, 返回 numpy 数组
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        data = f.read()
+    zero, dtype_code, ndim = struct.unpack('>HBB', data[:4])
+    if zero != 0 or dtype_code not in idx_dtypes:
+        raise ValueError('%s is not an idx file' % path)
+    shape = struct.unpack('>%dI' % ndim, data[4: 4 + 4 * ndim])
+    array = np.frombuffer(data, dtype=idx_dtypes[dtype_code], offset=4 + 4 * ndim)
+    return array.reshape(shape).astype(np.dtype(idx_dtypes[dtype_code]).newbyteorder('='))
+
+
+def load_idx_cached(path, cache_dir):
+    """
+    以 memmap 方式读取 idx 文件解压、解析后缓存在 cache_dir 中的 .npy, 缓存不存在或比源文件旧时重新生成
+    """
+    name = os.path.basename(path)
+    if name.endswith('.gz'):
+        name = name[:-3]
+    cache_path = os.path.join(cache_dir, name + '.npy')
+    if not os.path.exists(path):
+        if os.path.exists(cache_path):
+            return np.load(cache_path, mmap_mode='r')
+        raise IOError('%s not found, download the mnist idx files from http://yann.lecun.com/exdb/mnist/' % path)
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = '%s.tmp-%d.npy' % (cache_path[:-4], os.getpid())
+        np.save(tmp_path, read_idx(path))
+        os.rename(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode='r')
+
+
+class MnistDataSet(DataWapper):
+    """
+    与 input_data 的 DataSet 接口一致 (images、labels、num_examples、next_batch),
+    第一个 epoch 开始前和每个 epoch 结束时 shuffle
+    """
+
+    def __init__(self, images, labels):
+        super(MnistDataSet, self).__init__(images, labels)
+        self.shuffle()
+
+    @property
+    def images(self):
+        return self.x
+
+    @property
+    def labels(self):
+        return self.y
+
+    @property
+    def num_examples(self):
+        return self.total_count
+
+
+MnistDatasets = namedtuple('MnistDatasets', ['train', 'validation', 'test'])
+
+
+def read_mnist(mnist_dir=None, one_hot=True, dtype=np.float32, validation_size=5000, cache_dir=None):
+    """
+    直接解析 mnist_dir 中的 idx 源文件 (不下载, 可离线使用), 代替 input_data.read_data_sets.
+    解压后的数组缓存为 mnist_dir/npy/ 中的 .npy, 之后的启动只需 memmap 打开.
+    :param one_hot: labels 为 one-hot (float64, 与 input_data 一致), 否则为 0~9 的 uint8
+    :param dtype: np.float32 时 images 缩放到 [0, 1]; np.uint8 时为 0~255 的原始像素, 直接是缓存的 memmap, 不复制
+    :param validation_size: train 的前 validation_size 张图片作为 validation
+    :return: MnistDatasets(train, validation, test), 均为 MnistDataSet, images 为 [count, 784]
+    """
+    mnist_dir = mnist_dir or utils.mnist_dir
+    cache_dir = cache_dir or os.path.join(mnist_dir, 'npy')
+    train_images, train_labels, test_images, test_labels = [
+        load_idx_cached(os.path.join(mnist_dir, name), cache_dir) for name in mnist_source_files]
+
+    def dataset(images, labels):
+        images = images.reshape(images.shape[0], -1)
+        if np.dtype(dtype) == np.float32:
+            images = np.multiply(images, np.float32(1.0 / 255.0), dtype=np.float32)
+        elif np.dtype(dtype) != np.uint8:
+            raise ValueError('Invalid image dtype %r, expected uint8 or float32' % dtype)
+        if one_hot:
+            labels = np.eye(10)[labels]
+        return MnistDataSet(images, labels)
+
+    return MnistDatasets(train=dataset(train_images[validation_size:], train_labels[validation_size:]),
+                         validation=dataset(train_images[:validation_size], train_labels[:validation_size]),
+                         test=dataset(test_images, test_labels))
+
+
+class UpsamplingDataWapper(DataWapper):
+    """
+    保存原始的 28x28 mnist 数据, 在 next_batch 时才进行 resize、灰度->RGB、减均值和 RGB->BGR,
+    输出与 mnist_reshape 生成的 HDF5 文件中的数据完全一致, 无需预先生成并加载巨大的 HDF5 文件
+    """
+
+    def __init__(self, x, y, output_rows, output_cols, pre_img_rows=28, pre_img_cols=28, storage='bgr_float16',
+                 last_batch='partial', indices=None):
+        """
+        :param x: 原始图片, [count, pre_img_rows * pre_img_cols], 像素值 0~255
+        :param storage: batch 的存储格式, 见 ImageDataTransfer
+        :param last_batch: epoch 末尾不足 batch_size 的 batch 的处理方式, 见 DataWapper
+        :param indices: 属于该数据集的行号, 见 DataWapper
+        """
+        super(UpsamplingDataWapper, self).__init__(x, y, last_batch=last_batch, indices=indices)
+        self.transfer = ImageDataTransfer(pre_img_rows, pre_img_cols, x, output_rows, output_cols,
+                                          storage=storage)
+
+    def take(self, rows):
+        batch_x, batch_y = super(UpsamplingDataWapper, self).take(rows)
+        return self.transfer.transfer_batch(batch_x), batch_y
+
+    def take_into(self, rows, out_x, out_y):
+        # resize 的结果是新分配的数组, 只复用 batch 的 buffer
+        batch_x, batch_y = self.take(rows)
+        count = batch_x.shape[0]
+        out_x[:count] = batch_x
+        out_y[:count] = batch_y
+        return count
+
+
+def load_mnist_upsampled(output_rows, output_cols, train_split, storage='bgr_float16', last_batch='partial',
+                         split_file=None):
+    """
+    读取原始 mnist 数据集, 返回实时 resize 的 train、validation、test 数据
+    :param train_split: training/validation split
+    :param storage: batch 的存储格式, 见 ImageDataTransfer
+    :param last_batch: train 数据末尾不足 batch_size 的 batch 的处理方式, 见 DataWapper
+    :param split_file: 保存 train/validation 划分的文件, 见 load_or_create_split; None 时按顺序划分, 不保存
+    """
+    mnist = read_mnist(dtype=np.uint8)
+    images = mnist.train.images
     labels = mnist.train.labels
 
-    target_train_file = utils.train_mnist_2_imagenet_size_file
-    target_test_file = utils.test_mnist_2_imagenet_size_file
+    # split data into training and validation sets, 两者是同一份数据上的行号集合
+    if split_file is None:
+        train_index, validate_index = split_indices(len(images), train_split, shuffle=False)
+    else:
+        train_index, validate_index = load_or_create_split(split_file, len(images), train_split)
+    train_datas = UpsamplingDataWapper(images, labels, output_rows, output_cols, storage=storage,
+                                       last_batch=last_batch, indices=train_index)
+    validate_datas = UpsamplingDataWapper(images, labels, output_rows, output_cols, storage=storage,
+                                          indices=validate_index)
+    test_datas = UpsamplingDataWapper(mnist.test.images, mnist.test.labels, output_rows, output_cols,
+                                      storage=storage)
+    return train_datas, validate_datas, test_datas
+
+
+def load_mnist_finetune(target, train_split, upsample_on_the_fly=False, storage='bgr_float16', split_file=None):
+    """
+    finetune 脚本共用的 train、validation、test 数据, 按 batch 读取, 不把整个数据集读入内存
+    :param target: 'alexnet' (227x227) 或 'vggnet' (224x224), 见 mnist_reshape
+    :param upsample_on_the_fly: False 时读取 mnist_reshape 预先生成的 HDF5 文件, storage 需与生成文件时一致;
+        True 时实时 resize 原始 mnist 数据, 见 load_mnist_upsampled
+    :param split_file: 保存 train/validation 划分的文件, 见 load_or_create_split; None 时按顺序划分, 不保存
+    """
+    if upsample_on_the_fly:
+        size = 224 if target == 'vggnet' else 227
+        return load_mnist_upsampled(size, size, train_split, storage=storage, split_file=split_file)
+    train_file, test_file = target_files(target)
+    data = h5py.File(train_file, 'r')
+    # train、validation 为同一文件上的行号集合
+    count = data['images'].shape[0]
+    if split_file is None:
+        train_index, validate_index = split_indices(count, train_split, shuffle=False)
+    else:
+        train_index, validate_index = load_or_create_split(split_file, count, train_split)
+    train_datas = HDF5DataWapper(data['images'], data['labels'], indices=train_index)
+    validate_datas = HDF5DataWapper(data['images'], data['labels'], indices=validate_index)
+    test_data = h5py.File(test_file, 'r')
+    test_datas = HDF5DataWapper(test_data['images'], test_data['labels'])
+    return train_datas, validate_datas, test_datas
+
+
+# 多进程转换时, 由 pool initializer 设置的每个 worker 的全局状态
+_worker_transfers = None
+_worker_outputs = None
+
+
+def _shared_array(shape, dtype):
+    """
+    在共享内存中分配数组, 返回 (RawArray, numpy view)
+    """
+    buf = multiprocessing.RawArray(ctypes.c_uint8, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return buf, np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+
+def _init_transfer_worker(transfers, buffers, specs):
+    global _worker_transfers, _worker_outputs
+    _worker_transfers = transfers
+    _worker_outputs = [np.frombuffer(buf, dtype=dtype).reshape(shape) for buf, (shape, dtype) in zip(buffers, specs)]
+
+
+def _transfer_shard(shard):
+    """
+    worker 中转换一个 shard, 结果直接写入共享内存 buffer 中对应的位置, 不再 pickle 回主进程
+    """
+    split, start, end, buffer_index, offset = shard
+    _worker_outputs[buffer_index][offset: offset + end - start] = _worker_transfers[split].transfer_block(start, end)
+    return end - start
+
+
+def _transfer_shards(transfers, shard_size):
+    """
+    按 shard_size 划分各 split, 并交错排列各 split 的 shard, 使各 split 同时推进
+    """
+    shards = []
+    for split, transfer in enumerate(transfers):
+        count = transfer.pre_images.shape[0]
+        split_shard_size = shard_size or transfer.chunk_size
+        shards.append([(split, start, min(start + split_shard_size, count))
+                       for start in range(0, count, split_shard_size)])
+    return [shard for group in izip_longest(*shards) for shard in group if shard is not None]
+
+
+def iter_transfer_blocks(transfers, workers=1, shard_size=None):
+    """
+    流式转换多个 ImageDataTransfer, 按顺序逐块产生 (split, start, end, block).
+    workers > 1 时, 进程池的 worker 将结果写入共享内存中的一组循环使用的 slot, 每个 split 内的数据块按顺序产生,
+    block 是 slot 的视图, 在迭代到下一个数据块之前有效. 内存占用为 2 * workers 个数据块.
+    """
+    shards = _transfer_shards(transfers, shard_size)
+    widgets = ['Transfer: ', pbar.Percentage(), ' ', pbar.Bar('>'), ' ', pbar.ETA()]
+    image_bar = pbar.ProgressBar(widgets=widgets, maxval=sum(end - start for _, start, end in shards)).start()
+    done = 0
+
+    if workers <= 1:
+        for split, start, end in shards:
+            yield split, start, end, transfers[split].transfer_block(start, end)
+            done += end - start
+            image_bar.update(done)
+        image_bar.finish()
+        return
+
+    slot_rows = max(end - start for _, start, end in shards)
+    slot_spec = ((slot_rows,) + transfers[0].output_shape, transfers[0].output_dtype)
+    for transfer in transfers:
+        if ((slot_rows,) + transfer.output_shape, transfer.output_dtype) != slot_spec:
+            raise ValueError('All transfers must have the same output shape and dtype')
+    slots = [_shared_array(*slot_spec) for _ in range(2 * workers)]
+
+    pool = multiprocessing.Pool(workers, initializer=_init_transfer_worker,
+                                initargs=(transfers, [buf for buf, _ in slots], [slot_spec] * len(slots)))
+    try:
+        shards = iter(shards)
+        pending = deque()
+        free_slots = deque(range(len(slots)))
+        while True:
+            while free_slots:
+                shard = next(shards, None)
+                if shard is None:
+                    break
+                slot = free_slots.popleft()
+                task = pool.apply_async(_transfer_shard, (shard + (slot, 0),))
+                pending.append((shard, slot, task))
+            if not pending:
+                break
+
+            (split, start, end), slot, task = pending.popleft()
+            task.get()
+            yield split, start, end, slots[slot][1][: end - start]
+            free_slots.append(slot)
+            done += end - start
+            image_bar.update(done)
+    finally:
+        pool.terminate()
+        pool.join()
+    image_bar.finish()
+
+
+class BatchAugmenter(object):
+    """
+    对整个 batch 做向量化的数据增强, 每张图片的随机参数不同:
+    随机缩放裁剪 (裁剪 [min_crop_scale, 1] 比例的区域并放大回原尺寸)、水平翻转、平移和亮度扰动.
+    裁剪、翻转、平移合成为每张图片的行/列采样坐标 (最近邻), 整个 batch 只做一次 np.take;
+    超出图片的坐标取边缘像素, mnist 的边缘即背景. 适用于所有存储格式 (见 ImageDataTransfer).
+    """
+
+    def __init__(self, min_crop_scale=1.0, flip_prob=0.0, max_shift=0, brightness=0.0):
+        """
+        :param min_crop_scale: 随机裁剪区域边长的最小比例, 1.0 表示不裁剪
+        :param flip_prob: 水平翻转的概率, 数字图片翻转后不再是同一个类别, 默认不翻转
+        :param max_shift: 最大平移像素数
+        :param brightness: 亮度扰动的最大幅度, 像素值单位 (0~255)
+        """
+        self.min_crop_scale = min_crop_scale
+        self.flip_prob = flip_prob
+        self.max_shift = max_shift
+        self.brightness = brightness
+
+    def sample_coords(self, count, size, scale, random_state):
+        """
+        count 张图片在一个维度上的采样坐标 [count, size]
+        """
+        crop_size = scale * size
+        offset = random_state.uniform(0, 1, count) * (size - crop_size)
+        shift = random_state.randint(-self.max_shift, self.max_shift + 1, count)
+        coords = offset[:, None] + (np.arange(size) + 0.5) * (crop_size / size)[:, None] - shift[:, None]
+        return np.clip(np.floor(coords), 0, size - 1).astype(np.intp)
+
+    def augment(self, images, out=None, random_state=None):
+        """
+        :param images: [count, rows, cols, channels]
+        :param out: 输出数组, 与 images 的 shape、dtype 相同, 默认新分配
+        """
+        random_state = random_state or np.random
+        count, rows, cols = images.shape[:3]
+        if out is None:
+            out = np.empty_like(images)
+
+        scale = random_state.uniform(self.min_crop_scale, 1.0, count)
+        row_coords = self.sample_coords(count, rows, scale, random_state)
+        col_coords = self.sample_coords(count, cols, scale, random_state)
+        flip = random_state.uniform(0, 1, count) < self.flip_prob
+        col_coords[flip] = col_coords[flip, ::-1]
+
+        # 每个输出像素在 images 中的像素编号
+        pixels = (np.arange(count)[:, None, None] * rows + row_coords[:, :, None]) * cols + col_coords[:, None, :]
+        np.take(images.reshape((count * rows * cols,) + images.shape[3:]), pixels.ravel(), axis=0,
+                out=out.reshape((count * rows * cols,) + images.shape[3:]))
+
+        if self.brightness:
+            delta = random_state.uniform(-self.brightness, self.brightness, count)
+            delta = delta.reshape((count,) + (1,) * (images.ndim - 1))
+            if out.dtype == np.uint8:
+                jittered = out.astype(np.int16)
+                jittered += np.round(delta).astype(np.int16)
+                np.clip(jittered, 0, 255, out=jittered)
+                out[...] = jittered
+            else:
+                out += delta.astype(out.dtype)
+        return out
+
+
+# 数据增强的 worker 的全局状态, 由 pool initializer 设置
+_worker_augmenter = None
+_worker_slots = None
+
+
+def _init_augment_worker(augmenter, buffers, spec):
+    global _worker_augmenter, _worker_slots
+    _worker_augmenter = augmenter
+    _worker_slots = [(np.frombuffer(input_buf, dtype=spec[1]).reshape(spec[0]),
+                      np.frombuffer(output_buf, dtype=spec[1]).reshape(spec[0])) for input_buf, output_buf in buffers]
+
+
+def _augment_slot(task):
+    """
+    worker 中增强一个 slot 中的 batch, 结果写入 slot 的输出 buffer
+    """
+    slot, count, seed = task
+    inputs, outputs = _worker_slots[slot]
+    _worker_augmenter.augment(inputs[:count], out=outputs[:count], random_state=np.random.RandomState(seed))
+    return count
+
+
+class AugmentingDataWapper(object):
+    """
+    在进程池中对 data 的 batch 做数据增强, 与训练并行.
+    后台线程从 data 读取 batch, 复制到共享内存中循环使用的 slot, worker 增强后写入 slot 的输出 buffer,
+    next_batch 按顺序返回增强后的 batch. 返回的 x 是 slot 的视图, 在下一次 next_batch 之前有效.
+    随机数种子由主进程的 np.random 生成, np.random.seed 后结果可复现.
+    """
+
+    def __init__(self, data, batch_size, augmenter, workers=2, capacity=None):
+        """
+        :param data: DataWapper、PrefetchDataWapper 等, 提供 next_batch(batch_size)
+        :param augmenter: BatchAugmenter
+        :param capacity: slot 的数目, 默认 2 * workers
+        """
+        self.data = data
+        self.batch_size = batch_size
+        capacity = capacity or 2 * workers
+
+        # 每个 batch 读取之前 data 的状态, 见 state
+        self.track_state = hasattr(data, 'state') and getattr(data, 'shuffle_mode', 'index') == 'index'
+        self.feeding_state = data.state() if self.track_state else None
+        # 第一个 batch 确定 slot 的 shape 和 dtype
+        first_batch = data.next_batch(batch_size)
+        spec = ((batch_size,) + first_batch[0].shape[1:], first_batch[0].dtype)
+        buffers = [(_shared_array(*spec), _shared_array(*spec)) for _ in range(capacity)]
+        self.slots = [(inputs, outputs) for (_, inputs), (_, outputs) in buffers]
+        self.pool = multiprocessing.Pool(workers, initializer=_init_augment_worker,
+                                         initargs=(augmenter, [(input_buf, output_buf)
+                                                               for (input_buf, _), (output_buf, _) in buffers],
+                                                   spec))
+
+        self.free_slots = deque(range(capacity))
+        self.slot_released = threading.Semaphore(capacity)
+        self.ready = threading.Condition()
+        self.pending = deque()
+        self.held_slot = None
+        self.error = None
+        self.stopped = False
+
+        # 统计调用者等待 batch 的次数和时间
+        self.batch_count = 0
+        self.wait_count = 0
+        self.wait_time = 0.
+
+        self.thread = threading.Thread(target=self._feed, args=(first_batch,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def total_count(self):
+        return self.data.total_count
+
+    def _feed(self, batch):
+        try:
+            while True:
+                self.slot_released.acquire()
+                if self.stopped:
+                    return
+                if batch is None:
+                    if self.track_state:
+                        with self.ready:
+                            self.feeding_state = self.data.state()
+                    batch = self.data.next_batch(self.batch_size)
+                with self.ready:
+                    slot = self.free_slots.popleft()
+                count = batch[0].shape[0]
+                self.slots[slot][0][:count] = batch[0]
+                task = self.pool.apply_async(_augment_slot, ((slot, count, np.random.randint(1 << 31)),))
+                # y (和 mask) 可能是 data 复用的 buffer 的视图, 在下一次 data.next_batch 时被改写
+                rest = tuple(np.array(array) for array in batch[1:])
+                with self.ready:
+                    self.pending.append((slot, task, rest, self.feeding_state))
+                    self.feeding_state = None
+                    self.ready.notify_all()
+                batch = None
+        except Exception as e:
+            with self.ready:
+                self.error = e
+                self.ready.notify_all()
+
+    def release_held_slot(self):
+        if self.held_slot is not None:
+            with self.ready:
+                self.free_slots.append(self.held_slot)
+            self.held_slot = None
+            self.slot_released.release()
+
+    def next_batch(self, batch_size):
+        if batch_size != self.batch_size:
+            raise ValueError('AugmentingDataWapper prepares batches of size %d, got %d' %
+                             (self.batch_size, batch_size))
+        # 上一次返回的 batch 不再使用, 其 slot 可以复用
+        self.release_held_slot()
+        wait_start = time.time()
+        with self.ready:
+            waited = not self.pending
+            while not self.pending and self.error is None:
+                self.ready.wait()
+            if self.error is not None:
+                raise self.error
+            slot, task, rest, _ = self.pending.popleft()
+        # batch 还在读取或增强中
+        waited = waited or not task.ready()
+        count = task.get()
+        if waited:
+            self.wait_count += 1
+            self.wait_time += time.time() - wait_start
+        self.held_slot = slot
+        self.batch_count += 1
+        return (self.slots[slot][1][:count],) + tuple(rest)
+
+    def state(self):
+        """
+        调用者尚未取走的第一个 batch 读取之前 data 的状态, 见 PrefetchDataWapper.state.
+        增强的随机数种子不是状态的一部分, 恢复后同一 batch 的增强结果可能不同
+        """
+        if not self.track_state:
+            raise ValueError("state needs a data with shuffle_mode='index'")
+        with self.ready:
+            if self.pending:
+                return self.pending[0][3]
+            if self.feeding_state is not None:
+                return self.feeding_state
+            return self.data.state()
+
+    def stats(self):
+        """
+        返回 batch 数目, 调用者等待的次数、比例和总时间
+        """
+        return {'batch_count': self.batch_count,
+                'wait_count': self.wait_count,
+                'wait_ratio': self.wait_count / float(max(self.batch_count, 1)),
+                'wait_time': self.wait_time}
+
+    def close(self):
+        self.stopped = True
+        self.slot_released.release()
+        self.thread.join()
+        self.pool.terminate()
+        self.pool.join()
+        if hasattr(self.data, 'close'):
+            self.data.close()
+
+
+def shard_paths(path, shards):
+    """
+    数据集 path 的 shards 个 shard 文件, 如 train.h5 -> train-00000-of-00004.h5, ...; shards 为 1 时就是 path 本身
+    """
+    if shards == 1:
+        return [path]
+    root, ext = os.path.splitext(path)
+    return ['%s-%05d-of-%05d%s' % (root, i, shards, ext) for i in range(shards)]
+
+
+def select_shards(paths, process_index, process_count):
+    """
+    多个训练进程各自读取互不相交的 shard 子集
+    """
+    if not 0 <= process_index < process_count:
+        raise ValueError('process_index %d out of range [0, %d)' % (process_index, process_count))
+    return paths[process_index::process_count]
+
+
+class ShardedDatasetWriter(object):
+    """
+    按行的顺序将数据集依次写入多个 shard 文件, 除最后一个外每个 shard 包含 rows_per_shard 行,
+    接口与 HDF5DatasetWriter 一致
+    """
+
+    def __init__(self, paths, rows_per_shard, create_writer):
+        """
+        :param paths: shard 文件, 见 shard_paths
+        :param create_writer: create_writer(path) 创建单个 shard 的 HDF5DatasetWriter 或 MemmapDatasetWriter
+        """
+        self.paths = paths
+        self.path = ', '.join(paths)
+        self.rows_per_shard = rows_per_shard
+        self.count = 0
+        self.writers = []
+        try:
+            for path in paths:
+                self.writers.append(create_writer(path))
+        except BaseException:
+            self.close()
+            raise
+
+    def append(self, images, labels):
+        """
+        追加一个数据块, 跨越 shard 边界的数据块被拆分写入相邻的两个 shard
+        """
+        offset = 0
+        while offset < images.shape[0]:
+            shard = self.count // self.rows_per_shard
+            if shard >= len(self.writers):
+                raise ValueError('more than %d rows appended to %d shards' %
+                                 (self.rows_per_shard * len(self.writers), len(self.writers)))
+            rows = min(images.shape[0] - offset, (shard + 1) * self.rows_per_shard - self.count)
+            self.writers[shard].append(images[offset: offset + rows], labels[offset: offset + rows])
+            offset += rows
+            self.count += rows
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_dataset_file(path):
+    """
+    打开 HDF5 (.h5) 或 memmap (.npy) 格式的数据集, 返回 (file, images, labels), memmap 格式的 file 为 None
+    """
+    if path.endswith('.npy'):
+        images, labels = open_memmap_dataset(path)
+        return None, images, labels
+    f = h5py.File(path, 'r')
+    return f, f['images'], f['labels']
+
+
+def _read_shard(path, batch_size, last_batch, buffers, specs, free_slots, ready, seed):
+    """
+    在独立的线程或进程中读取一个 shard: 自己打开文件, 每取得一个空闲的 slot 就读取一个 batch 写入其中,
+    将 (slot, count) 放入 ready; 取得 None 时退出, 出错时将 (None, 错误信息) 放入 ready
+    """
+    try:
+        if seed is not None:
+            np.random.seed(seed)
+        f, images, labels = open_dataset_file(path)
+        if f is None:
+            data = DataWapper(images, labels, last_batch=last_batch)
+        else:
+            data = HDF5DataWapper(images, labels, last_batch=last_batch)
+        data.shuffle()
+        slots = [[np.frombuffer(buf, dtype=dtype).reshape(shape) for buf, (shape, dtype) in zip(slot_buffers, specs)]
+                 for slot_buffers in buffers]
+        while True:
+            slot = free_slots.get()
+            if slot is None:
+                break
+            batch_x, batch_y = data.next_batch(batch_size)
+            count = batch_x.shape[0]
+            slots[slot][0][:count] = batch_x
+            slots[slot][1][:count] = batch_y
+            ready.put((slot, count))
+        if f is not None:
+            f.close()
+    except Exception as e:
+        ready.put((None, '%s: %r' % (path, e)))
+
+
+class ShardedDataWapper(object):
+    """
+    并行读取多个 shard 文件 (见 mnist_reshape 的 shards), 每个 shard 由一个独立的线程或进程读取,
+    各自打开文件, 进程模式下不受 h5py 全局锁的限制, 读取速度随磁盘和 CPU 核数增长.
+    每个 shard 在自己的范围内 shuffle, next_batch 轮流返回各 shard 的 batch.
+    batch 写入共享内存中循环使用的 slot, 返回的 x、y 是 slot 的视图, 在下一次 next_batch 之前有效.
+    """
+
+    def __init__(self, paths, batch_size, mode='process', capacity=2, last_batch='partial'):
+        """
+        :param paths: shard 文件, 多个训练进程时用 select_shards 选取各自的子集
+        :param mode: 'thread' 或 'process', 每个 shard 一个读取线程/进程
+        :param capacity: 每个 shard 预先读取的 batch 数目
+        :param last_batch: 每个 shard 的 epoch 末尾不足 batch_size 的 batch 的处理方式, 见 DataWapper,
+            不支持 'pad_and_mask'
+        """
+        if mode not in ('thread', 'process'):
+            raise ValueError('Unknown mode %s' % mode)
+        if last_batch == 'pad_and_mask':
+            raise ValueError('ShardedDataWapper does not support last_batch=pad_and_mask')
+        check_last_batch(last_batch, 'index')
+        self.batch_size = batch_size
+        self.mode = mode
+        if mode == 'process':
+            queue_class, worker_class = multiprocessing.Queue, multiprocessing.Process
+        else:
+            queue_class, worker_class = queue.Queue, threading.Thread
+
+        self.paths = []
+        self.total_count = 0
+        self.slots = []
+        self.free_slots = []
+        self.ready = []
+        self.workers = []
+        for path in paths:
+            f, images, labels = open_dataset_file(path)
+            count = images.shape[0]
+            specs = [((batch_size,) + images.shape[1:], images.dtype), ((batch_size,) + labels.shape[1:], labels.dtype)]
+            if f is not None:
+                f.close()
+            if count == 0:
+                continue
+            buffers = [[_shared_array(*spec) for spec in specs] for _ in range(capacity)]
+            free_slots = queue_class()
+            for slot in range(capacity):
+                free_slots.put(slot)
+            ready = queue_class()
+            # 线程共享主线程的 np.random, 进程各自设置不同的种子
+            seed = np.random.randint(1 << 31) if mode == 'process' else None
+            worker = worker_class(target=_read_shard,
+                                  args=(path, batch_size, last_batch, [[buf for buf, _ in slot] for slot in buffers],
+                                        specs, free_slots, ready, seed))
+            worker.daemon = True
+            worker.start()
+            self.paths.append(path)
+            self.total_count += count
+            self.slots.append([[array for _, array in slot] for slot in buffers])
+            self.free_slots.append(free_slots)
+            self.ready.append(ready)
+            self.workers.append(worker)
+        if not self.workers:
+            raise ValueError('no rows in shards %s' % paths)
+
+        self.next_shard = 0
+        self.held_slot = None
+        # 统计调用者等待 batch 的次数和时间
+        self.batch_count = 0
+        self.wait_count = 0
+        self.wait_time = 0.
+
+    def release_held_slot(self):
+        if self.held_slot is not None:
+            shard, slot = self.held_slot
+            self.free_slots[shard].put(slot)
+            self.held_slot = None
+
+    def next_batch(self, batch_size):
+        if batch_size != self.batch_size:
+            raise ValueError('ShardedDataWapper prepares batches of size %d, got %d' % (self.batch_size, batch_size))
+        # 上一次返回的 batch 不再使用, 其 slot 可以复用
+        self.release_held_slot()
+        shard = self.next_shard
+        self.next_shard = (shard + 1) % len(self.workers)
+        wait_start = time.time()
+        waited = self.ready[shard].empty()
+        slot, count = self.ready[shard].get()
+        if slot is None:
+            raise RuntimeError('failed to read shard %s' % count)
+        if waited:
+            self.wait_count += 1
+            self.wait_time += time.time() - wait_start
+        self.held_slot = (shard, slot)
+        self.batch_count += 1
+        batch_x, batch_y = self.slots[shard][slot]
+        return batch_x[:count], batch_y[:count]
+
+    def stats(self):
+        """
+        返回 batch 数目, 调用者等待的次数、比例和总时间
+        """
+        return {'batch_count': self.batch_count,
+                'wait_count': self.wait_count,
+                'wait_ratio': self.wait_count / float(max(self.batch_count, 1)),
+                'wait_time': self.wait_time}
+
+    def close(self):
+        for free_slots in self.free_slots:
+            free_slots.put(None)
+        for worker in self.workers:
+            if self.mode == 'process':
+                # 进程可能阻塞在向 ready 队列写入数据上, 不等待其退出
+                worker.terminate()
+            worker.join()
+
+
+def target_files(target, output_format='h5'):
+    """
+    target 对应的 (train, test) 数据集文件
+    """
+    if output_format == 'npy':
+        if target == 'vggnet':
+            return utils.train_mnist_2_vggnet_size_npy_file, utils.test_mnist_2_vggnet_size_npy_file
+        return utils.train_mnist_2_imagenet_size_npy_file, utils.test_mnist_2_imagenet_size_npy_file
+    if target == 'vggnet':
+        return utils.train_mnist_2_vggnet_size_file, utils.test_mnist_2_vggnet_size_file
+    return utils.train_mnist_2_imagenet_size_file, utils.test_mnist_2_imagenet_size_file
+
+
+# utils.mnist_dir 中的 mnist 源文件, 见 read_mnist
+mnist_source_files = ['train-images-idx3-ubyte.gz', 'train-labels-idx1-ubyte.gz',
+                      't10k-images-idx3-ubyte.gz', 't10k-labels-idx1-ubyte.gz']
+# 转换算法改变 (输出不再一致) 时增加版本号, 使旧的缓存失效
+derived_dataset_version = 1
+
+
+def file_digest(paths, block_size=1 << 20):
+    """
+    多个文件内容的 sha1
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def derived_dataset_key(**params):
+    """
+    派生数据集的缓存 key: 所有影响输出文件内容的参数的 sha1
+    """
+    items = ','.join('%s=%r' % (name, params[name]) for name in sorted(params))
+    return hashlib.sha1(items.encode('utf-8')).hexdigest()
+
+
+def dataset_cache_size(entry):
+    """
+    缓存项目录中所有文件的字节数
+    """
+    size = 0
+    for root, _, files in os.walk(entry):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def evict_dataset_cache(cache_dir, max_bytes, keep=()):
+    """
+    缓存总大小超过 max_bytes 时, 按最近使用时间 (缓存项目录的 mtime) 从旧到新删除缓存项, keep 中的缓存项不删除
+    """
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if '.tmp-' not in name]
+    entries = [entry for entry in entries if os.path.isdir(entry)]
+    sizes = dict((entry, dataset_cache_size(entry)) for entry in entries)
+    total = sum(sizes.values())
+    keep = [os.path.abspath(entry) for entry in keep]
+    for entry in sorted(entries, key=os.path.getmtime):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(entry) in keep:
+            continue
+        print('Evict cached dataset %s (%.1f MB)' % (entry, sizes[entry] / 1024.0 ** 2))
+        shutil.rmtree(entry)
+        total -= sizes[entry]
+
+
+def link_cached_files(entry, target_paths, output_format='h5'):
+    """
+    将 target_paths 指向缓存项 entry 中的同名文件, 原有的文件或链接被替换
+    """
+    for target_path in target_paths:
+        paths = [target_path]
+        if output_format == 'npy':
+            paths.append(memmap_labels_path(target_path))
+        for path in paths:
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(os.path.join(os.path.abspath(entry), os.path.basename(path)), path)
+
+
+def mnist_reshape(target='alexnet', engine='vectorized', workers=1, chunk_rows=None, compression=None,
+                  output_format='h5', storage='bgr_float16', use_cache=True, cache_max_bytes=None, shards=1):
+    """
+    mnist 数据集进行reshape, target: alexnet、vggnet
+    转换结果逐块流式写入文件, 峰值内存为数据块大小而不是整个数据集.
+    转换结果保存在 utils.dataset_cache_dir 中, key 为源数据、转换方式、输出大小、均值、插值方式和存储格式的 hash,
+    target 文件是指向缓存的符号链接, 参数不变时重复运行直接命中缓存.
+    :param engine: ImageDataTransfer 的转换方式, 'vectorized' 或 'pil'
+    :param workers: 转换的进程数, 大于 1 时 train、test 两个 split 在同一个进程池中分 shard 同时转换
+    :param chunk_rows: HDF5 chunk 包含的图片数目, 默认为 finetune 脚本中一个训练 batch 的大小
+    :param compression: None/'none'、'lzf' 或 'gzip'
+    :param output_format: 'h5' 写入 HDF5 文件, 'npy' 写入 memmap 格式
+    :param storage: 图片的存储格式, 'bgr_float16'、'rgb_uint8' 或 'gray_uint8', 见 ImageDataTransfer
+    :param use_cache: False 时不使用缓存, 直接重新生成 target 文件
+    :param cache_max_bytes: 缓存的大小上限, 默认 utils.dataset_cache_max_bytes, 超出时删除最久未使用的缓存项
+    :param shards: 每个 split 写入的 shard 文件数目, 文件名见 shard_paths, 用 ShardedDataWapper 并行读取
+    """
+    print('transform mnist data to ' + target + ' model size...')
+    target_train_file, target_test_file = target_files(target, output_format)
     output_rows = 227
     output_cols = 227
+    batch_size = 200
     if target == 'vggnet':
         output_rows = 224
         output_cols = 224
-        target_train_file = utils.train_mnist_2_vggnet_size_file
-        target_test_file = utils.test_mnist_2_vggnet_size_file
+        batch_size = 100
+    chunk_rows = chunk_rows or batch_size
+    if compression == 'none' or output_format == 'npy':
+        compression = None
 
-    image_transfer = ImageDataTransfer(28, 28, images, output_rows, output_cols)
-    images_reshape = image_transfer.transfer()
-    try:
-        with h5py.File(target_train_file, 'w') as f:
-            f.create_dataset('images', data=images_reshape)
-            f.create_dataset('labels', data=labels)
-            print('Save transformed images to ' + target_train_file)
-    except Exception as e:
-        print('Unable to save images:', e)
+    # translate mnist -> alexnet model, vgg_net model
+    mnist = read_mnist(dtype=np.uint8)
+    output_dir = None
+    if use_cache:
+        source_files = [os.path.join(utils.mnist_dir, name) for name in mnist_source_files]
+        key = derived_dataset_key(source=file_digest(source_files), version=derived_dataset_version, engine=engine,
+                                  output_size=(output_rows, output_cols), interpolation='lanczos',
+                                  mean=sorted((c, float(v)) for c, v in imagenet_mean.items()),
+                                  storage=storage, output_format=output_format, chunk_rows=chunk_rows,
+                                  compression=compression, shards=shards)
+        cache_entry = os.path.join(utils.dataset_cache_dir, 'mnist_%dx%d_%s_%s' % (
+            output_rows, output_cols, storage, key))
+        if os.path.isdir(cache_entry):
+            # 更新 mtime, 作为 LRU 的最近使用时间
+            os.utime(cache_entry, None)
+            link_cached_files(cache_entry, shard_paths(target_train_file, shards) +
+                              shard_paths(target_test_file, shards), output_format)
+            print('Cache hit: ' + cache_entry)
+            return
+        output_dir = '%s.tmp-%d' % (cache_entry, os.getpid())
+        os.makedirs(output_dir)
+
+    target_paths = [target_train_file, target_test_file]
+    if output_dir is not None:
+        target_paths = [os.path.join(output_dir, os.path.basename(path)) for path in target_paths]
+    splits = list(zip([mnist.train, mnist.test], target_paths))
+    transfers = [ImageDataTransfer(28, 28, dataset.images, output_rows, output_cols, engine=engine,
+                                   storage=storage)
+                 for dataset, _ in splits]
+    image_shape = transfers[0].output_shape
+    image_dtype = transfers[0].output_dtype
+
+    def create_writer(target_file, dataset):
+        if output_format == 'npy':
+            return MemmapDatasetWriter(target_file, image_shape, dataset.labels.shape[1:],
+                                       image_dtype=image_dtype, label_dtype=dataset.labels.dtype)
+        return HDF5DatasetWriter(target_file, image_shape, dataset.labels.shape[1:],
+                                 image_dtype=image_dtype, label_dtype=dataset.labels.dtype,
+                                 chunk_rows=chunk_rows, compression=compression)
 
-    images = mnist.test.images * 255
-    labels = mnist.test.labels
-    image_transfer = ImageDataTransfer(28, 28, images, output_rows, output_cols)
-    images_reshape = image_transfer.transfer()
     try:
-        with h5py.File(target_test_file, 'w') as f:
-            f.create_dataset('images', data=images_reshape)
-            f.create_dataset('labels', data=labels)
-            print('Save transformed images to ' + target_test_file)
-    except Exception as e:
-        print('Unable to save images:', e)
+        if shards == 1:
+            writers = [create_writer(target_file, dataset) for dataset, target_file in splits]
+        else:
+            # 每个 shard 的行数取 chunk 的整数倍, 数据块不跨越 shard 边界
+            writers = [ShardedDatasetWriter(shard_paths(target_file, shards),
+                                            -(-dataset.labels.shape[0] // (shards * chunk_rows)) * chunk_rows,
+                                            lambda path, dataset=dataset: create_writer(path, dataset))
+                       for dataset, target_file in splits]
+        try:
+            # shard 与 HDF5 chunk 对齐, 每次追加写入完整的 chunk
+            for split, start, end, block in iter_transfer_blocks(transfers, workers, shard_size=chunk_rows):
+                writers[split].append(block, splits[split][0].labels[start: end])
+        finally:
+            for writer in writers:
+                writer.close()
+    except BaseException:
+        if output_dir is not None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        raise
+
+    if output_dir is None:
+        for writer in writers:
+            print('Save transformed images to ' + writer.path)
+        return
+    if os.path.isdir(cache_entry):
+        # 其他进程已经生成了相同的缓存项
+        shutil.rmtree(output_dir)
+    else:
+        os.rename(output_dir, cache_entry)
+    link_cached_files(cache_entry, shard_paths(target_train_file, shards) +
+                      shard_paths(target_test_file, shards), output_format)
+    print('Save transformed images to ' + cache_entry)
+    if cache_max_bytes is None:
+        cache_max_bytes = utils.dataset_cache_max_bytes
+    evict_dataset_cache(utils.dataset_cache_dir, cache_max_bytes, keep=[cache_entry])
 
 
 def main():
-    target = 'vggnet'
-    if len(sys.argv) > 1:
-        target = sys.argv[1]
-    mnist_reshape(target)
+    parser = argparse.ArgumentParser(description='transform mnist data to alexnet/vggnet model size')
+    parser.add_argument('target', nargs='?', default='vggnet', choices=['alexnet', 'vggnet'])
+    parser.add_argument('--engine', default='vectorized', choices=['vectorized', 'pil'])
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of transfer processes, 0 for all cpu cores')
+    parser.add_argument('--chunk-rows', type=int, default=None,
+                        help='images per HDF5 chunk, default one training batch')
+    parser.add_argument('--compression', default='none', choices=['none', 'lzf', 'gzip'])
+    parser.add_argument('--format', default='h5', choices=['h5', 'npy'], help='output file format')
+    parser.add_argument('--storage', default='bgr_float16', choices=['bgr_float16', 'rgb_uint8', 'gray_uint8'],
+                        help='uint8 storages leave mean subtraction and BGR flip to the model graph')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='rebuild the target files in place instead of using the dataset cache')
+    parser.add_argument('--cache-max-gb', type=float, default=None,
+                        help='size cap of the dataset cache, least recently used datasets are evicted first')
+    parser.add_argument('--to-npy', action='store_true',
+                        help='convert the existing HDF5 files of target to memmap format')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare batch throughput of the HDF5 and memmap train files of target')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='number of shard files per split, read in parallel by ShardedDataWapper')
+    args = parser.parse_args()
+
+    if args.to_npy:
+        for h5_file, npy_file in zip(target_files(args.target, 'h5'), target_files(args.target, 'npy')):
+            h5_to_memmap(h5_file, npy_file)
+    elif args.benchmark:
+        benchmark_batch_throughput(target_files(args.target, 'h5')[0], target_files(args.target, 'npy')[0])
+    else:
+        workers = args.workers or multiprocessing.cpu_count()
+        cache_max_bytes = None
+        if args.cache_max_gb is not None:
+            cache_max_bytes = int(args.cache_max_gb * 1024 ** 3)
+        mnist_reshape(args.target, args.engine, workers, args.chunk_rows, args.compression, args.format,
+                      args.storage, not args.no_cache, cache_max_bytes, args.shards)
+
 
 if __name__ == '__main__':
     main()
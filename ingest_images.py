@@ -0,0 +1,197 @@
+#!/home/sunnymarkliu/software/miniconda2/bin/python
+# _*_ coding: utf-8 _*_
+
+"""
+将按类别分子目录存放的图片 (image_dir/<class>/xxx.jpg) 转换为训练数据集:
+进程池并行解码、resize 并转换为 storage 格式, 逐块流式写入 HDF5 (.h5) 或 memmap (.npy) 文件,
+labels 为类别的整数编号, 可以直接用 HDF5DataWapper/DataWapper 读取.
+
+已写入的图片记录在 <target>.files.txt 中 (与数据集的行一一对应), 类别名记录在 <target>.classes.txt 中 (行号即 label),
+无法解码的图片记录在 <target>.skipped.txt 中; 再次运行时跳过已写入和无法解码的图片, 只追加新增的图片,
+中断后重新运行即可从中断处继续.
+
+@author: MarkLiu
+@time  : 17-3-22 下午2:40
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from datautil import HDF5DatasetWriter, MemmapDatasetWriter, rgb_to_storage
+
+image_extensions = ('.jpeg', '.jpg', '.png', '.bmp')
+
+
+def side_files(target):
+    """
+    数据集 target 的 (已写入图片列表, 类别名列表, 无法解码的图片列表) 文件, 以完整的 target 文件名为前缀,
+    同一目录中的 xxx.h5 和 xxx.npy 不会共用
+    """
+    return target + '.files.txt', target + '.classes.txt', target + '.skipped.txt'
+
+
+def read_lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def list_class_images(image_dir, classes):
+    """
+    列出 image_dir 每个类别子目录 (包括其子目录) 中的图片, 返回 [(相对 image_dir 的路径, label)].
+    新出现的类别追加到 classes 末尾, 已有类别的 label 不变
+    """
+    images = []
+    for name in sorted(os.listdir(image_dir)):
+        class_dir = os.path.join(image_dir, name)
+        if not os.path.isdir(class_dir):
+            continue
+        if name not in classes:
+            classes.append(name)
+        label = classes.index(name)
+        for root, dirs, files in os.walk(class_dir):
+            dirs.sort()
+            for f in sorted(files):
+                if f.lower().endswith(image_extensions):
+                    images.append((os.path.relpath(os.path.join(root, f), image_dir), label))
+    return images
+
+
+def load_image(args):
+    """
+    在 worker 进程中解码图片并 resize 为 (rows, cols), 转换为 storage 格式, 无法解码时返回 None
+    """
+    path, rows, cols, storage = args
+    try:
+        im = Image.open(path)
+        # gray_uint8 取亮度, 其余格式为 RGB
+        im = im.convert('L').convert('RGB') if storage == 'gray_uint8' else im.convert('RGB')
+        im = im.resize((cols, rows), Image.LANCZOS)
+    except (IOError, OSError, ValueError):
+        return None
+    return rgb_to_storage(np.array(im), storage)
+
+
+def ingest_images(image_dir, target, rows, cols, storage='bgr_float16', workers=1, chunk_rows=100,
+                  compression=None, rebuild=False, report_every=1000):
+    """
+    将 image_dir 中的图片转换并写入数据集 target, target 已存在时只追加新增的图片
+    :param target: .npy 写入 memmap 格式, 其他写入 HDF5
+    :param storage: 图片的存储格式, 'bgr_float16'、'rgb_uint8' 或 'gray_uint8', 见 ImageDataTransfer
+    :param workers: 解码的进程数
+    :param chunk_rows: 每次追加写入的图片数目, 也是 HDF5 chunk 的大小
+    :param rebuild: True 时丢弃已有的数据集重新生成
+    :param report_every: 每写入多少张图片报告一次速度
+    """
+    if storage not in ('bgr_float16', 'rgb_uint8', 'gray_uint8'):
+        raise ValueError('Unknown storage %s' % storage)
+    files_path, classes_path, skipped_path = side_files(target)
+    # 没有图片列表的 target 不是之前生成的数据集, 重新生成
+    if rebuild or not os.path.exists(files_path):
+        for path in (files_path, classes_path, skipped_path):
+            if os.path.exists(path):
+                os.remove(path)
+    append = os.path.exists(files_path)
+    done = read_lines(files_path)
+    classes = read_lines(classes_path)
+    known_paths = set(done) | set(read_lines(skipped_path))
+    pending = [(path, label) for path, label in list_class_images(image_dir, classes) if path not in known_paths]
+    with open(classes_path, 'w') as f:
+        f.write(''.join(name + '\n' for name in classes))
+
+    image_shape = (rows, cols, 1 if storage == 'gray_uint8' else 3)
+    image_dtype = np.float16 if storage == 'bgr_float16' else np.uint8
+    if target.endswith('.npy'):
+        writer = MemmapDatasetWriter(target, image_shape, (), image_dtype=image_dtype, label_dtype=np.int64,
+                                     append=append)
+    else:
+        writer = HDF5DatasetWriter(target, image_shape, (), image_dtype=image_dtype, label_dtype=np.int64,
+                                   chunk_rows=chunk_rows, compression=compression, append=append)
+    try:
+        # 数据块先于图片列表写入, 中断时数据集可能多出未记录的行, 以图片列表为准
+        if writer.count < len(done):
+            raise ValueError('%s has %d rows but %s lists %d images, rebuild it' % (
+                target, writer.count, files_path, len(done)))
+        writer.truncate(len(done))
+        print('%s: %d images, %d classes, %d new images' % (target, len(done), len(classes), len(pending)))
+        if not pending:
+            return 0, 0
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            with open(files_path, 'a') as files, open(skipped_path, 'a') as skipped_files:
+                ingested, skipped = _write_images(pool, image_dir, pending, rows, cols, storage, writer, files,
+                                                  skipped_files, chunk_rows, report_every)
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        writer.close()
+    return ingested, skipped
+
+
+def _write_images(pool, image_dir, pending, rows, cols, storage, writer, files, skipped_files, chunk_rows,
+                  report_every):
+    """
+    按 pending 的顺序解码图片, 每 chunk_rows 张追加写入 writer 并记录到 files, 无法解码的图片记录到 skipped_files
+    """
+    start = time.time()
+    ingested = 0
+    skipped = 0
+    block_images, block_labels, block_paths = [], [], []
+    tasks = [(os.path.join(image_dir, path), rows, cols, storage) for path, _ in pending]
+    results = pool.imap(load_image, tasks, chunksize=8)
+    for index, ((path, label), image) in enumerate(zip(pending, results)):
+        if image is None:
+            print('skip ' + path + ': cannot decode image')
+            skipped_files.write(path + '\n')
+            skipped_files.flush()
+            skipped += 1
+        else:
+            block_images.append(image)
+            block_labels.append(label)
+            block_paths.append(path)
+        if len(block_paths) == chunk_rows or (index == len(pending) - 1 and block_paths):
+            writer.append(np.array(block_images), np.array(block_labels, dtype=np.int64))
+            writer.flush()
+            files.write(''.join(p + '\n' for p in block_paths))
+            files.flush()
+            reported = ingested // report_every
+            ingested += len(block_paths)
+            block_images, block_labels, block_paths = [], [], []
+            if ingested // report_every > reported:
+                print('%d/%d images, %.1f images/sec' % (ingested, len(pending), ingested / (time.time() - start)))
+    elapsed = time.time() - start
+    print('ingested %d images (%d skipped) in %.1fs, %.1f images/sec' % (
+        ingested, skipped, elapsed, ingested / max(elapsed, 1e-6)))
+    return ingested, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='convert a class-per-subdirectory image folder to a training '
+                                                 'dataset, appending only new images when it already exists')
+    parser.add_argument('image_dir')
+    parser.add_argument('target', help='output dataset, .h5 for HDF5 or .npy for memmap format')
+    parser.add_argument('--size', type=int, nargs=2, default=[227, 227], metavar=('ROWS', 'COLS'),
+                        help='output image size, 227 227 for alexnet, 224 224 for vggnet')
+    parser.add_argument('--storage', default='bgr_float16', choices=['bgr_float16', 'rgb_uint8', 'gray_uint8'],
+                        help='uint8 storages leave mean subtraction and BGR flip to the model graph')
+    parser.add_argument('--workers', type=int, default=0, help='number of decoding processes, 0 for all cpu cores')
+    parser.add_argument('--chunk-rows', type=int, default=100, help='images per write and per HDF5 chunk')
+    parser.add_argument('--compression', default='none', choices=['none', 'lzf', 'gzip'])
+    parser.add_argument('--rebuild', action='store_true', help='discard the existing dataset and start over')
+    parser.add_argument('--report-every', type=int, default=1000, help='report images/sec every N images')
+    args = parser.parse_args()
+
+    ingest_images(args.image_dir, args.target, args.size[0], args.size[1], args.storage,
+                  args.workers or multiprocessing.cpu_count(), args.chunk_rows, args.compression, args.rebuild,
+                  args.report_every)
+
+
+if __name__ == '__main__':
+    main()
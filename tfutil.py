@@ -0,0 +1,166 @@
+#!/home/sunnymarkliu/software/miniconda2/bin/python
+# _*_ coding: utf-8 _*_
+
+"""
+tensorflow 模型共用的图构建工具
+
+@author: MarkLiu
+@time  : 17-3-20 下午3:12
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import utils
+
+
+def input_placeholder(dtype, shape, name, input_tensor=None):
+    """
+    模型的输入: input_tensor 为 None 时是普通的 placeholder; 否则是以 input_tensor (如 dataset_input_pipeline
+    的输出) 为默认值的 placeholder_with_default, 不 feed 时从输入流水线读取 batch, feed 时 (classify、测试集等)
+    使用 feed 的数据, 不会消耗流水线中的 batch.
+    """
+    if input_tensor is None:
+        return tf.placeholder(dtype, shape=shape, name=name)
+    if input_tensor.dtype != dtype:
+        input_tensor = tf.cast(input_tensor, dtype)
+    return tf.placeholder_with_default(input_tensor, shape=shape, name=name)
+
+
+def image_input_layer(height, width, storage='bgr_float16', channels=3, name='input_layer', input_tensor=None,
+                      batch_size=None):
+    """
+    创建图片输入的 placeholder 以及送入网络的 float32 图片. placeholder 的 dtype 与数据的存储格式一致,
+    feed 时不会在 host 上把整个 batch 转换为 float32, 转换是图中的第一个 op.
+    storage='bgr_float16': 输入已经减均值的 float16 BGR 图片, [None, height, width, channels]
+    storage='bgr_float32': 输入已经减均值的 float32 BGR 图片, 如 image_net_demo 中 cv2 读取的图片
+    storage='rgb_uint8': 输入 uint8 RGB 图片 [None, height, width, 3], 在图中转换为 float32、RGB->BGR 并减均值
+    storage='gray_uint8': 输入 uint8 单通道图片 [None, height, width, 1], 在图中扩展为 3 通道并减均值
+    uint8 的预处理结果与 datautil.ImageDataTransfer 的 'bgr_float16' 输出一致 (除 float16 的舍入误差外).
+    :param input_tensor: 输入流水线的图片 tensor, 见 input_placeholder
+    :param batch_size: 静态的 batch 维度, None 为动态
+    :return: (placeholder, float32 images)
+    """
+    if storage == 'bgr_float32':
+        x = input_placeholder(tf.float32, [batch_size, height, width, channels], name, input_tensor)
+        return x, x
+    if storage == 'bgr_float16':
+        x = input_placeholder(tf.float16, [batch_size, height, width, channels], name, input_tensor)
+        with tf.name_scope('preprocess'):
+            images = tf.cast(x, tf.float32)
+        return x, images
+    if storage not in ('rgb_uint8', 'gray_uint8'):
+        raise ValueError('Unknown input storage %s' % storage)
+
+    input_channels = 1 if storage == 'gray_uint8' else 3
+    x = input_placeholder(tf.uint8, [batch_size, height, width, input_channels], name, input_tensor)
+    with tf.name_scope('preprocess'):
+        images = tf.cast(x, tf.float32)
+        if storage == 'gray_uint8':
+            images = tf.tile(images, [1, 1, 1, 3])
+        else:
+            # 'RGB'->'BGR', historical reasons in OpenCV
+            images = tf.reverse(images, axis=[3])
+        bgr_mean = [float(utils.imagenet_mean['B']), float(utils.imagenet_mean['G']),
+                    float(utils.imagenet_mean['R'])]
+        images = images - tf.constant(bgr_mean, dtype=tf.float32)
+    return x, images
+
+
+def dataset_input_pipeline(data, batch_size, num_parallel_calls=4, prefetch_batches=2):
+    """
+    基于 tf.data 的输入流水线: 生成 batch 的行号 (沿用 data 的 shuffle 方式) -> num_parallel_calls 个线程并行
+    读取 batch (data.take) -> prefetch. 返回的 (images, labels) 每次 sess.run 产生下一个 batch,
+    batch 的准备在 TF 运行时中与训练并行, 不需要 feed_dict.
+    模型以 input_tensors=(images, labels) 构建后, train(None, None, ...) 从流水线读取 batch.
+    :param data: shuffle_mode='index' 的 DataWapper 及其子类 (HDF5DataWapper、UpsamplingDataWapper 等),
+                 last_batch 为 'drop_last' 或 'wrap_around' 时 batch 维度是静态的 batch_size
+    :param prefetch_batches: 预先准备的 batch 数
+    """
+    if data.shuffle_mode != 'index':
+        # 原地 shuffle 会改写其他线程正在读取的行
+        raise ValueError("dataset_input_pipeline needs shuffle_mode='index', got %s" % data.shuffle_mode)
+    if data.last_batch == 'pad_and_mask':
+        # 模型的训练不使用 mask, 填充行会参与训练
+        raise ValueError("dataset_input_pipeline does not support last_batch='pad_and_mask'")
+    static_batch_size = None if data.last_batch == 'partial' else batch_size
+
+    # 读取一行, 确定 batch 的 dtype 和 shape
+    sample_x, sample_y = data.take_batch(data.index[:1] if data.index is not None else slice(0, 1))
+    output_dtypes = [tf.as_dtype(sample_x.dtype), tf.as_dtype(sample_y.dtype)]
+
+    def batch_rows():
+        while True:
+            rows = data.next_rows(batch_size)
+            if isinstance(rows, slice):
+                rows = np.arange(rows.start, rows.stop)
+            yield rows
+
+    def read_batch(rows):
+        images, labels = tf.py_func(data.take_batch, [rows], output_dtypes)
+        images.set_shape((static_batch_size,) + sample_x.shape[1:])
+        labels.set_shape((static_batch_size,) + sample_y.shape[1:])
+        return images, labels
+
+    with tf.name_scope('input_pipeline'):
+        dataset = tf.data.Dataset.from_generator(batch_rows, tf.int64, tf.TensorShape([None]))
+        dataset = dataset.map(read_batch, num_parallel_calls=num_parallel_calls)
+        dataset = dataset.prefetch(prefetch_batches)
+        images, labels = dataset.make_one_shot_iterator().get_next()
+    return images, labels
+
+
+def benchmark_input_pipeline(train_step, data, batch_size, steps=100, warmup=10):
+    """
+    比较 feed_dict 与输入流水线的训练速度 (steps/sec). 先测试 feed_dict, 再测试流水线,
+    流水线启动后会在后台推进 data 的 pointer.
+    :param train_step: train_step(x, y) 执行一步训练, x、y 为 None 时从输入流水线读取 batch,
+                       如 lambda x, y: model.train(x, y, learning_rate)
+    :param data: 构建输入流水线的 DataWapper, feed_dict 方式用它的 next_batch 读取 batch
+    """
+    def steps_per_sec(use_feed_dict):
+        for step in range(warmup + steps):
+            if step == warmup:
+                start = time.time()
+            if use_feed_dict:
+                batch_x, batch_y = data.next_batch(batch_size)
+                train_step(batch_x, batch_y)
+            else:
+                train_step(None, None)
+        return steps / (time.time() - start)
+
+    result = {'feed_dict': steps_per_sec(True)}
+    result['pipeline'] = steps_per_sec(False)
+    print('feed_dict: %.2f steps/sec, input pipeline: %.2f steps/sec, speedup %.2fx' % (
+        result['feed_dict'], result['pipeline'], result['pipeline'] / result['feed_dict']))
+    return result
+
+
+def benchmark_static_batch(build_model, data, batch_size, steps=50, warmup=5, learning_rate=0.001):
+    """
+    比较动态 (None) 与静态 batch 维度的同一模型的训练速度 (steps/sec) 和推理速度 (images/sec),
+    两个模型分别在独立的 tf.Graph 中构建, 用相同的几个 batch 反复运行, 不计数据准备的时间.
+    :param build_model: build_model(batch_size) 以该 batch_size 参数构建分类模型并调用 init(), 返回模型,
+                        batch_size 为 None 或静态的 batch 大小
+    :param data: DataWapper, 每个 batch 都必须是 batch_size 行, 如 last_batch='drop_last'
+    """
+    batches = [data.next_batch(batch_size)[:2] for _ in range(2)]
+    result = {}
+    for name, static_batch_size in (('dynamic', None), ('static', batch_size)):
+        with tf.Graph().as_default():
+            model = build_model(static_batch_size)
+            timings = []
+            for run_step in (lambda x, y: model.train(x, y, learning_rate), lambda x, y: model.classify(x)):
+                for step in range(warmup + steps):
+                    if step == warmup:
+                        start = time.time()
+                    batch_x, batch_y = batches[step % len(batches)]
+                    run_step(batch_x, batch_y)
+                timings.append(time.time() - start)
+            model.sess.close()
+        result[name] = {'train_steps_per_sec': steps / timings[0],
+                        'inference_images_per_sec': steps * batch_size / timings[1]}
+        print('%s batch: train %.2f steps/sec, inference %.1f images/sec' % (
+            name, result[name]['train_steps_per_sec'], result[name]['inference_images_per_sec']))
+    return result
@@ -0,0 +1,577 @@
+#!/home/sunnymarkliu/software/miniconda2/bin/python
+# _*_ coding: utf-8 _*_
+
+"""
+finetune 脚本共用的训练循环
+
+@author: MarkLiu
+@time  : 17-3-23 下午3:05
+"""
+from __future__ import division, print_function
+
+import glob
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import utils
+from datautil import (AugmentingDataWapper, DataWapper, HDF5DataWapper, MemmapDatasetWriter, PrefetchDataWapper,
+                      derived_dataset_key, evict_dataset_cache, iter_batches, iter_prefetch, open_memmap_dataset)
+
+
+def constant_lr(learning_rate):
+    """
+    固定的学习率
+    """
+    return lambda epoch: learning_rate
+
+
+def step_decay(learning_rate, every_epochs, factor=0.5):
+    """
+    第 0 个 epoch 之后以及之后每 every_epochs 个 epoch 学习率乘以 factor,
+    与原来各脚本中 `if epoch % every_epochs == 0: learning_rate /= 2` 的效果一致
+    """
+    return lambda epoch: learning_rate * factor ** ((epoch + every_epochs - 1) // every_epochs)
+
+
+class _TimedSession(object):
+    """
+    包装模型的 tf.Session, 累计 sess.run 的时间
+    """
+
+    def __init__(self, sess):
+        self.sess = sess
+        self.run_time = 0.
+
+    def run(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.sess.run(*args, **kwargs)
+        finally:
+            self.run_time += time.time() - start
+
+    def __getattr__(self, name):
+        return getattr(self.sess, name)
+
+
+def checkpoint_arrays(variables, values, trainer_state):
+    """
+    把变量的值和 Trainer 的状态 (训练进度、学习率、数据的读取位置和顺序、np.random 的状态) 组织为 npz 的数组
+    :param variables: tf.Variable 列表, values 为对应的值
+    """
+    trainer_state = dict(trainer_state)
+    arrays = dict(('variables/' + variable.name, value) for variable, value in zip(variables, values))
+    data_state = trainer_state.pop('data_state')
+    if data_state is not None:
+        arrays['data/pointer'] = np.int64(data_state['pointer'])
+        if data_state['index'] is not None:
+            arrays['data/index'] = np.asarray(data_state['index'])
+    random_state = trainer_state.pop('random_state')
+    arrays['random/keys'] = random_state[1]
+    arrays['random/others'] = np.array(random_state[2:], dtype=np.float64)
+    for key, value in trainer_state.items():
+        arrays['trainer/' + key] = np.array(value)
+    return arrays
+
+
+def read_checkpoint(path):
+    """
+    读取 checkpoint_arrays 保存的 npz, 返回 (变量名到值的 dict, Trainer 的状态)
+    """
+    with np.load(path) as checkpoint:
+        arrays = dict((key, checkpoint[key]) for key in checkpoint.files)
+    values = dict((key[len('variables/'):], value) for key, value in arrays.items() if key.startswith('variables/'))
+    trainer_state = dict((key[len('trainer/'):], value.item()) for key, value in arrays.items()
+                         if key.startswith('trainer/'))
+    trainer_state['data_state'] = None
+    if 'data/pointer' in arrays:
+        trainer_state['data_state'] = {'pointer': int(arrays['data/pointer']), 'index': arrays.get('data/index')}
+    others = arrays['random/others']
+    trainer_state['random_state'] = ('MT19937', arrays['random/keys'], int(others[0]), int(others[1]), others[2])
+    return values, trainer_state
+
+
+def latest_checkpoint(checkpoint_dir):
+    """
+    checkpoint_dir 中 global step 最大的 checkpoint, 没有时返回 None
+    """
+    paths = checkpoint_paths(checkpoint_dir)
+    return paths[-1] if paths else None
+
+
+def checkpoint_paths(checkpoint_dir):
+    """
+    checkpoint_dir 中按 global step 排序的 ckpt-<global step>.npz, 不包括写入中的临时文件
+    """
+    paths = glob.glob(os.path.join(checkpoint_dir, 'ckpt-[0-9]*.npz'))
+    return sorted(path for path in paths if os.path.basename(path)[len('ckpt-'):-len('.npz')].isdigit())
+
+
+class AsyncCheckpointWriter(object):
+    """
+    在后台线程中写入 checkpoint, 训练循环只需把变量的值复制到内存中, 不等待磁盘写入.
+    先写入临时文件再改名, 中途退出不会留下不完整的 checkpoint. 最多一个 checkpoint 等待写入,
+    写入跟不上时 save 等待, 内存中最多同时有两份变量的副本.
+    """
+
+    def __init__(self, max_to_keep=3):
+        """
+        :param max_to_keep: 每个目录中保留的 ckpt-*.npz 数目, 更早的被删除
+        """
+        self.max_to_keep = max_to_keep
+        self.queue = queue.Queue(1)
+        self.error = None
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, arrays = item
+            try:
+                directory = os.path.dirname(path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                # 临时文件以 . 开头, 中途退出时留下的不完整文件不会被当作 checkpoint
+                temp_path = os.path.join(directory, '.' + os.path.basename(path) + '.tmp')
+                with open(temp_path, 'wb') as f:
+                    np.savez(f, **arrays)
+                os.rename(temp_path, path)
+                if os.path.basename(path).startswith('ckpt-'):
+                    for old_path in checkpoint_paths(directory)[:-self.max_to_keep]:
+                        os.remove(old_path)
+                print('Save checkpoint to ' + path)
+            except Exception as e:
+                self.error = e
+
+    def save(self, path, arrays):
+        """
+        把 arrays 写入 path (.npz), 立即返回
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((path, arrays))
+
+    def close(self):
+        """
+        等待所有 checkpoint 写入完成
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class StreamingEvaluator(object):
+    """
+    以固定大小的 batch 流式地评估整个数据集, 累计 accuracy、loss 和每个类别的计数 (混淆矩阵),
+    内存和激活的占用只与 batch_size 有关, 与数据集的大小无关; 读取下一个 batch 与当前 batch 的计算并行.
+    模型需提供 evaluate_batch(x, y), 返回 (每个样本的 loss, 预测的类别).
+    """
+
+    def __init__(self, model, batch_size=100, num_classes=None, pad_batches=False):
+        """
+        :param num_classes: 类别数目, None 时由 one-hot labels 的宽度或出现的最大类别决定
+        :param pad_batches: 模型使用静态的 batch 维度时, 最后一个较短的 batch 用第一行补齐到 batch_size,
+            补齐行的结果不计入
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.num_classes = num_classes
+        self.pad_batches = pad_batches
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.loss_sum = 0.
+        # confusion[i, j]: 类别 i 被预测为 j 的样本数
+        self.confusion = np.zeros((self.num_classes or 0,) * 2, dtype=np.int64)
+
+    def update(self, x, y):
+        """
+        累计一个 batch 的结果
+        """
+        count = x.shape[0]
+        short = self.batch_size - count
+        if self.pad_batches and short > 0:
+            x = np.concatenate([x, np.repeat(x[:1], short, axis=0)])
+            y = np.concatenate([y, np.repeat(y[:1], short, axis=0)])
+        losses, predictions = self.model.evaluate_batch(x, y)
+        labels = np.argmax(y[:count], axis=1) if y.ndim > 1 else np.asarray(y[:count], dtype=np.int64)
+        predictions = np.asarray(predictions[:count], dtype=np.int64)
+
+        num_classes = max(self.confusion.shape[0], y.shape[1] if y.ndim > 1 else 0,
+                          labels.max() + 1, predictions.max() + 1)
+        if num_classes > self.confusion.shape[0]:
+            confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+            confusion[:self.confusion.shape[0], :self.confusion.shape[0]] = self.confusion
+            self.confusion = confusion
+        self.confusion += np.bincount(labels * num_classes + predictions,
+                                      minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+        self.loss_sum += float(np.sum(losses[:count]))
+        self.count += count
+
+    def result(self):
+        """
+        返回样本数、accuracy、平均 loss、每个类别的样本数和 accuracy, 以及混淆矩阵
+        """
+        class_counts = self.confusion.sum(axis=1)
+        correct = np.diag(self.confusion)
+        return {'count': self.count,
+                'accuracy': correct.sum() / float(max(self.count, 1)),
+                'loss': self.loss_sum / max(self.count, 1),
+                'per_class_count': class_counts,
+                'per_class_accuracy': correct / np.maximum(class_counts, 1).astype(np.float64),
+                'confusion': self.confusion}
+
+    def evaluate(self, datas):
+        """
+        评估整个数据集
+        :param datas: DataWapper 及其子类 (内存数组、HDF5 或 memmap), 或者 (x, y) 数组、memmap、h5py dataset
+        """
+        self.reset()
+        for batch in iter_prefetch(iter_batches(datas, self.batch_size)):
+            self.update(batch[0], batch[1])
+        return self.result()
+
+
+class BottleneckModel(object):
+    """
+    以 layer 的输出 (见 build_bottleneck_cache) 为输入的 head, 只训练 model 的 SKIP_LAYER 中的层,
+    提供 train、evaluate_batch 和 sess, 可用于 Trainer 和 StreamingEvaluator
+    """
+
+    def __init__(self, model, layer):
+        self.model = model
+        self.layer = layer
+        # 中间层的输出与输入有相同的静态 batch 维度
+        self.BATCH_SIZE = getattr(model, 'BATCH_SIZE', None)
+
+    @property
+    def sess(self):
+        return self.model.sess
+
+    @sess.setter
+    def sess(self, sess):
+        self.model.sess = sess
+
+    def train(self, x, y, learning_rate, keep_prob=0.8, compute_accuracy=True):
+        return self.model.train_head(x, y, self.layer, learning_rate, keep_prob=keep_prob,
+                                     compute_accuracy=compute_accuracy)
+
+    def evaluate_batch(self, x, y):
+        return self.model.evaluate_head_batch(x, y, self.layer)
+
+
+def frozen_weights_digest(model):
+    """
+    head (model.HEAD_VARIABLES) 之外的可训练变量的值的 sha1, 它们改变时缓存的中间层输出失效
+    """
+    head_names = set(variable.name for variable in model.HEAD_VARIABLES)
+    variables = sorted((variable for variable in tf.trainable_variables() if variable.name not in head_names),
+                       key=lambda variable: variable.name)
+    digest = hashlib.sha1()
+    for variable, value in zip(variables, model.sess.run(variables)):
+        digest.update(variable.name.encode('utf-8'))
+        digest.update(np.ascontiguousarray(value).tobytes())
+    return digest.hexdigest()
+
+
+def build_bottleneck_cache(model, layer, datas, name, batch_size=100, dtype=np.float16, cache_dir=None,
+                           cache_max_bytes=None):
+    """
+    用冻结的前几层计算 datas 中每个样本在 layer 的输出, 以 memmap 格式缓存, 返回缓存上的 DataWapper,
+    之后的每个 epoch 用 BottleneckModel 只训练 head, 不再计算冻结的层.
+    缓存的 key 为冻结的变量的值、layer、datas 的行和 dtype 的 hash, 参数不变时重复运行直接命中缓存.
+    缓存的是未经数据增强的图片的输出, 训练 head 时不再做数据增强.
+    :param datas: DataWapper 及其子类, 或者 (x, y) 数组, 按行的顺序读取
+    :param name: datas 的来源, 如 'mnist_227x227_bgr_float16_train', 计入 key, 来源的内容改变时需要改变 name
+    :param dtype: 缓存的存储格式
+    :param cache_dir: 默认 utils.bottleneck_cache_dir
+    :param cache_max_bytes: 缓存的大小上限, 默认 utils.dataset_cache_max_bytes, 超出时删除最久未使用的缓存项
+    """
+    cache_dir = cache_dir or utils.bottleneck_cache_dir
+    if isinstance(datas, DataWapper):
+        rows = datas.indices if datas.indices is not None else np.arange(datas.total_count)
+    else:
+        rows = np.arange(datas[0].shape[0])
+    key = derived_dataset_key(weights=frozen_weights_digest(model), layer=layer, name=name,
+                              dtype=np.dtype(dtype).str,
+                              rows=hashlib.sha1(np.ascontiguousarray(rows, dtype=np.int64).tobytes()).hexdigest())
+    cache_entry = os.path.join(cache_dir, '%s_%s_%s' % (name, layer, key))
+    path = os.path.join(cache_entry, 'features.npy')
+    if os.path.isdir(cache_entry):
+        # 更新 mtime, 作为 LRU 的最近使用时间
+        os.utime(cache_entry, None)
+        print('Cache hit: ' + cache_entry)
+        return DataWapper(*open_memmap_dataset(path))
+
+    start = time.time()
+    output_dir = '%s.tmp-%d' % (cache_entry, os.getpid())
+    os.makedirs(output_dir)
+    writer = None
+    try:
+        for batch in iter_prefetch(iter_batches(datas, batch_size)):
+            features = model.bottleneck(batch[0], layer)
+            if writer is None:
+                writer = MemmapDatasetWriter(os.path.join(output_dir, 'features.npy'), features.shape[1:],
+                                             batch[1].shape[1:], image_dtype=dtype, label_dtype=batch[1].dtype)
+            writer.append(features, batch[1])
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        shutil.rmtree(output_dir, ignore_errors=True)
+        raise
+    writer.close()
+
+    if os.path.isdir(cache_entry):
+        # 其他进程已经生成了相同的缓存项
+        shutil.rmtree(output_dir)
+    else:
+        os.rename(output_dir, cache_entry)
+    print('Cache %d %s outputs of %s to %s in %.1fs' % (writer.count, layer, name, cache_entry, time.time() - start))
+    if cache_max_bytes is None:
+        cache_max_bytes = utils.dataset_cache_max_bytes
+    evict_dataset_cache(cache_dir, cache_max_bytes, keep=[cache_entry])
+    return DataWapper(*open_memmap_dataset(path))
+
+
+class Trainer(object):
+    """
+    通用的训练循环, 适用于提供以下接口的模型 (Alexnet、Vgg16、GoogleInceptionV1、NetworkInNetwork、BottleneckModel 等):
+    train(x, y, learning_rate, keep_prob=..., compute_accuracy=...) 返回 (loss, accuracy 或 None),
+    evaluate_batch(x, y) 返回 (每个样本的 loss, 预测的类别), 见 StreamingEvaluator, 以及可替换的 sess.
+    负责后台预取 (和数据增强) 训练 batch、按学习率策略设置学习率、定期在 validation 上评估和保存 checkpoint,
+    并记录每一步的时间: 等待数据、sess.run 计算和其余的 Python 开销.
+    checkpoint 由 AsyncCheckpointWriter 在后台写入, 除变量外还保存训练进度、学习率和训练数据的读取位置与顺序,
+    resume 时从下一个 batch 继续, 不重复已训练的部分 epoch.
+    """
+
+    def __init__(self, model, train_datas, batch_size, lr_schedule, keep_prob=0.8, validate_datas=None,
+                 eval_every=1, eval_batch_size=None, pad_batches=None, log_every=10, accuracy_every=1,
+                 prefetch_capacity=4, prefetch_threads=2, augmenter=None, augment_workers=2, checkpoint_dir=None,
+                 checkpoint_every=1, checkpoint_every_steps=0, best_checkpoint_dir=None, resume=False):
+        """
+        :param train_datas: DataWapper 及其子类, 由 Trainer 包装为后台预取的 PrefetchDataWapper 并在训练结束时关闭
+        :param lr_schedule: lr_schedule(epoch) 返回该 epoch 的学习率, 见 constant_lr、step_decay
+        :param validate_datas: 每 eval_every 个 epoch 用 StreamingEvaluator 评估整个 validation 数据集,
+            None 时不评估
+        :param eval_batch_size: 评估的 batch 大小, 默认 2 * batch_size; 模型有静态的 batch 维度 (BATCH_SIZE) 时
+            为该大小
+        :param pad_batches: 评估时是否把最后一个较短的 batch 补齐, 见 StreamingEvaluator;
+            None 时模型有静态的 batch 维度才补齐
+        :param log_every: 每多少步打印一次 train loss/accuracy 和时间, 0 时不打印
+        :param accuracy_every: 每多少步计算一次 train accuracy, 与训练在同一次 sess.run 中计算
+        :param prefetch_capacity: 预先准备的 batch 数目, 0 时不预取, 在训练线程中读取 batch
+        :param prefetch_threads: 预取的线程数, HDF5DataWapper 只使用一个线程
+        :param augmenter: BatchAugmenter, 在 augment_workers 个进程中对训练 batch 做数据增强
+        :param checkpoint_dir: 每 checkpoint_every 个 epoch 以及每 checkpoint_every_steps 步 (0 时不按步保存)
+            将 checkpoint 保存到该目录下的 ckpt-<global step>.npz, None 时不保存
+        :param best_checkpoint_dir: validation accuracy 超过之前的最好结果时, 将 checkpoint 保存为该目录下的 best.npz
+        :param resume: 从 checkpoint_dir 中最新的 checkpoint 恢复变量、训练进度和训练数据的读取位置,
+            恢复后 fit 从中断的 epoch 和下一个 batch 继续. np.random 恢复为保存时的状态, 但后台线程可能已经
+            为下一个 epoch shuffle 过, 因此之后 epoch 的读取顺序不一定与不中断时相同
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.lr_schedule = lr_schedule
+        self.keep_prob = keep_prob
+        self.validate_datas = validate_datas
+        self.eval_every = eval_every
+        # 静态的 batch 维度只接受该大小的 batch, 评估也使用该大小, 最后一个较短的 batch 补齐
+        static_batch_size = getattr(model, 'BATCH_SIZE', None)
+        if static_batch_size is not None:
+            if batch_size != static_batch_size or eval_batch_size not in (None, static_batch_size):
+                raise ValueError('The model has a static batch size of %d, got batch_size=%d, eval_batch_size=%s' %
+                                 (static_batch_size, batch_size, eval_batch_size))
+            eval_batch_size = static_batch_size
+        if pad_batches is None:
+            pad_batches = static_batch_size is not None
+        self.evaluator = StreamingEvaluator(model, eval_batch_size or 2 * batch_size, pad_batches=pad_batches)
+        self.log_every = log_every
+        self.accuracy_every = accuracy_every
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_every_steps = checkpoint_every_steps
+        self.best_checkpoint_dir = best_checkpoint_dir
+        self.steps_per_epoch = train_datas.total_count // batch_size
+        self.session = model.sess
+        self.variables = tf.global_variables()
+        self.writer = AsyncCheckpointWriter() if checkpoint_dir or best_checkpoint_dir else None
+        # 原地 shuffle 的读取顺序不能保存, 只恢复变量和训练进度
+        self.save_data_state = getattr(train_datas, 'shuffle_mode', None) == 'index' and hasattr(train_datas, 'state')
+        self.global_step = 0
+        # 下一个训练的 epoch, 以及其中已经训练的步数
+        self.epoch = 0
+        self.epoch_step = 0
+        self.resume_learning_rate = None
+        self.best_accuracy = -np.inf
+        if resume and checkpoint_dir is not None:
+            path = latest_checkpoint(checkpoint_dir)
+            if path is not None:
+                # 在预取线程开始读取之前恢复读取位置
+                self.restore(path, train_datas)
+
+        if prefetch_capacity:
+            if isinstance(train_datas, HDF5DataWapper):
+                # HDF5 的读取本身是串行的, 且只缓存一个数据块, 多个线程交替读取相邻的 batch 时
+                # 跨块的数据块会被重复读取, 一个线程按顺序读取保证每个 epoch 每个数据块只读取一次
+                prefetch_threads = 1
+            # batch 写入预先分配的 buffer 循环使用, 每步不再分配新的数组
+            train_datas = PrefetchDataWapper(train_datas, batch_size, capacity=prefetch_capacity,
+                                             num_threads=prefetch_threads, reuse_buffers=True)
+        if augmenter is not None:
+            train_datas = AugmentingDataWapper(train_datas, batch_size, augmenter, workers=augment_workers)
+        self.train_datas = train_datas
+        self.timed_session = _TimedSession(model.sess)
+        # 最近一次计算的 train accuracy
+        self.last_accuracy = np.nan
+        # 每一步的 (等待数据, sess.run, Python 开销) 时间, 秒
+        self.step_times = []
+        self.history = []
+
+    def trainer_state(self, learning_rate):
+        return {'global_step': self.global_step, 'epoch': self.epoch, 'epoch_step': self.epoch_step,
+                'learning_rate': learning_rate, 'best_accuracy': self.best_accuracy,
+                'data_state': self.train_datas.state() if self.save_data_state else None,
+                'random_state': np.random.get_state()}
+
+    def save_checkpoint(self, path, learning_rate):
+        """
+        在训练的间隙把变量复制到内存, 由后台线程写入 path
+        """
+        # sess.run 返回的数组可能与变量共用内存, 之后的训练会修改它, 因此复制一份
+        values = [np.array(value) for value in self.session.run(self.variables)]
+        self.writer.save(path, checkpoint_arrays(self.variables, values, self.trainer_state(learning_rate)))
+
+    def checkpoint_path(self):
+        return os.path.join(self.checkpoint_dir, 'ckpt-%08d.npz' % self.global_step)
+
+    def restore(self, path, train_datas):
+        """
+        从 save_checkpoint 保存的 checkpoint 恢复变量、训练进度、np.random 和 train_datas 的读取位置
+        """
+        values, state = read_checkpoint(path)
+        missing = [variable.name for variable in self.variables if variable.name not in values]
+        if missing:
+            raise ValueError('%s has no value for %s' % (path, ', '.join(missing)))
+        for variable in self.variables:
+            variable.load(values[variable.name], self.session)
+        self.global_step = state['global_step']
+        self.epoch = state['epoch']
+        self.epoch_step = state['epoch_step']
+        # 从 epoch 中间继续时沿用保存时的学习率
+        self.resume_learning_rate = state['learning_rate'] if self.epoch_step else None
+        self.best_accuracy = state['best_accuracy']
+        np.random.set_state(state['random_state'])
+        if self.save_data_state and state['data_state'] is not None:
+            train_datas.restore_state(state['data_state'])
+        print('Restore checkpoint from %s, epoch %d, step %d' % (path, self.epoch + 1, self.epoch_step))
+
+    def train_epoch(self, epoch):
+        """
+        训练一个 epoch, 返回 (学习率, 平均的 train loss, 平均的 train accuracy)
+        """
+        learning_rate = self.lr_schedule(epoch) if self.resume_learning_rate is None else self.resume_learning_rate
+        self.resume_learning_rate = None
+        timed_sess = self.timed_session
+        # 从 checkpoint 恢复时只训练 epoch 剩余的步数
+        steps = self.steps_per_epoch - self.epoch_step
+        losses = np.empty(steps)
+        accuracies = np.full(steps, np.nan)
+        for i in range(steps):
+            step_start = time.time()
+            run_time = timed_sess.run_time
+            batch = self.train_datas.next_batch(self.batch_size)
+            data_time = time.time() - step_start
+            compute_accuracy = self.global_step % self.accuracy_every == 0
+            losses[i], accuracy = self.model.train(batch[0], batch[1], learning_rate, keep_prob=self.keep_prob,
+                                                   compute_accuracy=compute_accuracy)
+            if compute_accuracy:
+                accuracies[i] = self.last_accuracy = accuracy
+            run_time = timed_sess.run_time - run_time
+            self.step_times.append((data_time, run_time, time.time() - step_start - data_time - run_time))
+            self.global_step += 1
+            self.epoch_step += 1
+            if self.log_every and self.global_step % self.log_every == 0:
+                print('step %d, learning rate = %.9f, train loss = %.9f, train accuracy = %.5f, %s' % (
+                    self.global_step, learning_rate, losses[i], self.last_accuracy,
+                    self.format_timing(self.step_times[-self.log_every:])))
+            if (self.checkpoint_dir is not None and self.checkpoint_every_steps and
+                    self.global_step % self.checkpoint_every_steps == 0 and self.epoch_step < self.steps_per_epoch):
+                self.save_checkpoint(self.checkpoint_path(), learning_rate)
+        self.epoch = epoch + 1
+        self.epoch_step = 0
+        accuracies = accuracies[~np.isnan(accuracies)]
+        return learning_rate, float(np.mean(losses)), float(np.mean(accuracies)) if len(accuracies) else np.nan
+
+    def fit(self, epochs):
+        """
+        训练到第 epochs 个 epoch, 从 checkpoint 恢复时从中断的 epoch 继续, 返回每个 epoch 的记录
+        """
+        # 模型的 sess.run 经过 timed_session 计时
+        self.model.sess = self.timed_session
+        try:
+            for epoch in range(self.epoch, epochs):
+                epoch_start = time.time()
+                start_step = self.global_step
+                learning_rate, train_loss, train_accuracy = self.train_epoch(epoch)
+                record = {'epoch': epoch + 1, 'learning_rate': learning_rate, 'train_loss': train_loss,
+                          'train_accuracy': train_accuracy,
+                          'images_per_sec': (self.global_step - start_step) * self.batch_size /
+                          (time.time() - epoch_start)}
+                message = 'Epoch: %04d, learning rate = %.9f, train loss = %.9f' % (
+                    epoch + 1, learning_rate, train_loss)
+                if self.validate_datas is not None and epoch % self.eval_every == 0:
+                    result = self.evaluator.evaluate(self.validate_datas)
+                    record['validation_accuracy'] = result['accuracy']
+                    record['validation_loss'] = result['loss']
+                    message += ', validation loss = %.9f, validation accuracy = %.5f' % (result['loss'],
+                                                                                         result['accuracy'])
+                    if result['accuracy'] > self.best_accuracy:
+                        self.best_accuracy = result['accuracy']
+                        if self.best_checkpoint_dir is not None:
+                            self.save_checkpoint(os.path.join(self.best_checkpoint_dir, 'best.npz'), learning_rate)
+                print('%s, %.1f images/sec' % (message, record['images_per_sec']))
+                self.history.append(record)
+                if self.checkpoint_dir is not None and (epoch + 1) % self.checkpoint_every == 0:
+                    self.save_checkpoint(self.checkpoint_path(), learning_rate)
+        finally:
+            self.model.sess = self.session
+        return self.history
+
+    def format_timing(self, step_times):
+        data_time, run_time, overhead = np.mean(step_times, axis=0) * 1000
+        return 'data %.1fms, compute %.1fms, python %.1fms per step' % (data_time, run_time, overhead)
+
+    def timing(self):
+        """
+        返回所有训练步的平均和总的 (等待数据, sess.run, Python 开销) 时间, 以及输入的等待统计
+        """
+        step_times = np.array(self.step_times).reshape(-1, 3)
+        total = step_times.sum(axis=0)
+        mean = step_times.mean(axis=0) if len(step_times) else total
+        return {'steps': len(step_times),
+                'data_wait': float(total[0]), 'compute': float(total[1]), 'python': float(total[2]),
+                'data_wait_per_step': float(mean[0]), 'compute_per_step': float(mean[1]),
+                'python_per_step': float(mean[2]),
+                'input': self.train_datas.stats() if hasattr(self.train_datas, 'stats') else None}
+
+    def close(self):
+        if hasattr(self.train_datas, 'close'):
+            self.train_datas.close()
+        if self.writer is not None:
+            self.writer.close()
@@ -5,6 +5,8 @@
 @author: MarkLiu
 @time  : 17-3-3 下午4:41
 """
+import numpy as np
+
 base_dir = '/home/sunnymarkliu/projects/deeplearning/'
 tensorboard_dir = base_dir + 'tensorboard/'
 checkpoint_path = base_dir + 'checkpoint/'
@@ -16,6 +18,18 @@ train_mnist_2_imagenet_size_file = base_dir + 'datasets/mnist/train_mnist_2_imag
 test_mnist_2_imagenet_size_file = base_dir + 'datasets/mnist/test_mnist_2_imagenet_size.h5'
 train_mnist_2_vggnet_size_file = base_dir + 'datasets/mnist/train_mnist_2_vggnet_size.h5'
 test_mnist_2_vggnet_size_file = base_dir + 'datasets/mnist/test_mnist_2_vggnet_size.h5'
+# numpy.memmap 格式 (.npy), labels 保存在同名的 *_labels.npy 中
+train_mnist_2_imagenet_size_npy_file = base_dir + 'datasets/mnist/train_mnist_2_imagenet_size.npy'
+test_mnist_2_imagenet_size_npy_file = base_dir + 'datasets/mnist/test_mnist_2_imagenet_size.npy'
+train_mnist_2_vggnet_size_npy_file = base_dir + 'datasets/mnist/train_mnist_2_vggnet_size.npy'
+test_mnist_2_vggnet_size_npy_file = base_dir + 'datasets/mnist/test_mnist_2_vggnet_size.npy'
+# mnist train 的 train/validation 划分, 各 finetune 脚本共用
+mnist_split_file = base_dir + 'datasets/mnist/train_validation_split.npz'
+# mnist_reshape 生成的数据集缓存, 上面的数据集文件是指向缓存的符号链接
+dataset_cache_dir = base_dir + 'datasets/cache/'
+dataset_cache_max_bytes = 100 * 1024 ** 3
+# 冻结的前几层输出的缓存, 见 trainer.build_bottleneck_cache
+bottleneck_cache_dir = base_dir + 'datasets/bottleneck/'
 
 # model
 pre_trained_alex_model = base_dir + 'pre_trained_model/bvlc_alexnet.npy'
@@ -24,3 +38,6 @@ pre_trained_inception_v1_model = base_dir + 'pre_trained_model/inception_v1.ckpt
 pre_trained_inception_v2_model = base_dir + 'pre_trained_model/inception_v2.ckpt'
 pre_trained_inception_v3_model = base_dir + 'pre_trained_model/inception_v3.ckpt'
 pre_trained_inception_v4_model = base_dir + 'pre_trained_model/inception_v4.ckpt'
+
+# datasets preprocess
+imagenet_mean = {'R': np.float16(103.939), 'G': np.float16(116.779), 'B': np.float16(123.68)}